@@ -0,0 +1,304 @@
+"""
+Dashboard queries over the `logs` table.
+
+`ensure_analytics` adds indexes on the timestamp, model and score columns and an hourly rollup
+table, `logs_hourly`, with one row per (hour, model). The rollup holds the comment count and a
+1-5 histogram of both scores. An AFTER INSERT trigger keeps it up to date, so summary queries
+read a few rows per hour instead of scanning every logged comment. Windows that do not start or
+end on a full hour read the partial hours from `logs` through the timestamp index.
+
+Examples:
+    python analytics.py --hours 24
+    python analytics.py --hours 1 --score offensive_score --min-score 4
+"""
+import argparse
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+SCORE_COLUMNS = ("sentiment_score", "offensive_score")
+SCORES = range(1, 6)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+Timestamp = Union[datetime, str]
+
+_HISTOGRAM_COLUMNS = [f"{column.split('_')[0]}_{score}" for column in SCORE_COLUMNS for score in SCORES]
+
+_ROLLUP_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS logs_hourly(
+        hour TEXT NOT NULL,
+        model TEXT NOT NULL,
+        n INT NOT NULL DEFAULT 0,
+        sentiment_sum INT NOT NULL DEFAULT 0,
+        offensive_sum INT NOT NULL DEFAULT 0,
+        {", ".join(f"{column} INT NOT NULL DEFAULT 0" for column in _HISTOGRAM_COLUMNS)},
+        PRIMARY KEY (hour, model)
+    )
+"""
+
+def _rollup_values(row:str) -> list[str]:
+    """SQL expressions for one rollup row built from the `logs` columns of `row` (`new` or a table alias)."""
+    values = [
+        f"substr({row}.timestamp, 1, 13) || ':00:00'",
+        f"coalesce({row}.model, '')",
+        "1",
+        f"coalesce({row}.sentiment_score, 0)",
+        f"coalesce({row}.offensive_score, 0)",
+    ]
+    # A NULL score counts in no bucket rather than making the whole row NULL
+    values += [f"coalesce({row}.{column} = {score}, 0)" for column in SCORE_COLUMNS for score in SCORES]
+    return values
+
+_ROLLUP_COLUMNS = ["hour", "model", "n", "sentiment_sum", "offensive_sum"] + _HISTOGRAM_COLUMNS
+
+_ROLLUP_TRIGGER = f"""
+    CREATE TRIGGER logs_hourly_insert AFTER INSERT ON logs
+    BEGIN
+        INSERT INTO logs_hourly({", ".join(_ROLLUP_COLUMNS)})
+        VALUES ({", ".join(_rollup_values("new"))})
+        ON CONFLICT(hour, model) DO UPDATE SET
+            {", ".join(f"{column} = {column} + excluded.{column}" for column in _ROLLUP_COLUMNS[2:])};
+    END
+"""
+
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS logs_timestamp ON logs(timestamp)",
+    "CREATE INDEX IF NOT EXISTS logs_model_timestamp ON logs(model, timestamp)",
+    "CREATE INDEX IF NOT EXISTS logs_sentiment_timestamp ON logs(sentiment_score, timestamp)",
+    "CREATE INDEX IF NOT EXISTS logs_offensive_timestamp ON logs(offensive_score, timestamp)",
+]
+
+def ensure_analytics(con:sqlite3.Connection):
+    """
+    Create the indexes and the rollup table if they are missing, and (re)create the rollup trigger.
+    A rollup table created next to an existing `logs` table is backfilled in the same transaction.
+
+    Args:
+        con (sqlite3.Connection): connection to a database that already has the logs table
+    """
+    # IMMEDIATE keeps other writers out between the backfill and the trigger creation
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in _INDEXES:
+            con.execute(statement)
+        exists = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs_hourly'").fetchone()
+        con.execute(_ROLLUP_TABLE)
+        if not exists:
+            _backfill(con)
+        # Recreated every time, so databases created by older versions get the current trigger
+        con.execute("DROP TRIGGER IF EXISTS logs_hourly_insert")
+        con.execute(_ROLLUP_TRIGGER)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+def _backfill(con:sqlite3.Connection, since:str=""):
+    hour, model, _, *values = _rollup_values("l")
+    con.execute(f"""
+        INSERT INTO logs_hourly({", ".join(_ROLLUP_COLUMNS)})
+        SELECT {hour}, {model}, count(*), {", ".join(f"sum({value})" for value in values)}
+        FROM logs AS l
+        WHERE l.timestamp >= ?
+        GROUP BY 1, 2
+    """, (since,))
+
+def rebuild_rollups(con:sqlite3.Connection):
+    """
+    Recompute `logs_hourly` from `logs`, e.g. after rows were edited by hand.
+    Hours before the oldest row in `logs` are kept, since their rows may have been moved to the
+    Parquet archive (see archive.py); later hours whose rows were deleted disappear from the rollup.
+    """
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        oldest = con.execute("SELECT min(timestamp) FROM logs").fetchone()[0]
+        if oldest is not None:
+            since = oldest[:13] + ":00:00"
+            con.execute("DELETE FROM logs_hourly WHERE hour >= ?", (since,))
+            _backfill(con, since)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+def _to_datetime(value:Optional[Timestamp]) -> datetime:
+    if value is None:
+        return datetime.now()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def _floor_hour(value:datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def _ceil_hour(value:datetime) -> datetime:
+    floor = _floor_hour(value)
+    return floor if floor == value else floor + timedelta(hours=1)
+
+def _fmt(value:datetime) -> str:
+    return value.strftime(TIMESTAMP_FORMAT)
+
+def _check_score(score:str):
+    if score not in SCORE_COLUMNS:
+        raise ValueError(f"Unknown score column '{score}'. Choose one of: {', '.join(SCORE_COLUMNS)}")
+
+def count_by_model(con:sqlite3.Connection, since:Timestamp, until:Optional[Timestamp]=None,
+                   score:str="offensive_score", min_score:int=1) -> dict:
+    """
+    Count logged comments per model whose `score` is at least `min_score`, e.g. offensive
+    comments in the last hour. Exact to the second: full hours come from the rollup, the
+    partial hours at either end from `logs`.
+
+    Args:
+        con (sqlite3.Connection): connection to the logs database
+        since (datetime | str): start of the window, inclusive, in the local time of the logs
+        until (datetime | str, optional): end of the window, exclusive. Defaults to now.
+        score (str, optional): 'sentiment_score' or 'offensive_score'. Defaults to 'offensive_score'.
+        min_score (int, optional): lowest score counted. Defaults to 1.
+
+    Returns:
+        counts (dict): model name -> number of comments
+    """
+    _check_score(score)
+    start, end = _to_datetime(since), _to_datetime(until)
+    first_hour, last_hour = _ceil_hour(start), _floor_hour(end)
+
+    counts = {}
+    def add(rows):
+        for model, n in rows:
+            if n:
+                counts[model] = counts.get(model, 0) + n
+
+    def add_raw(lo:datetime, hi:datetime):
+        if lo < hi:
+            add(con.execute(f"""
+                SELECT model, count(*) FROM logs
+                WHERE timestamp >= ? AND timestamp < ? AND {score} >= ?
+                GROUP BY model
+            """, (_fmt(lo), _fmt(hi), min_score)))
+
+    if first_hour >= last_hour:
+        add_raw(start, end)
+    else:
+        add_raw(start, first_hour)
+        prefix = score.split("_")[0]
+        bins = " + ".join(f"{prefix}_{s}" for s in SCORES if s >= min_score) or "0"
+        add(con.execute(f"""
+            SELECT nullif(model, ''), sum({bins}) FROM logs_hourly
+            WHERE hour >= ? AND hour < ?
+            GROUP BY model
+        """, (_fmt(first_hour), _fmt(last_hour))))
+        add_raw(last_hour, end)
+    return counts
+
+def _rollup_filter(since:Timestamp, until:Optional[Timestamp], model:Optional[str]) -> tuple[str, list]:
+    where = "hour >= ? AND hour < ?"
+    params = [_fmt(_floor_hour(_to_datetime(since))), _fmt(_ceil_hour(_to_datetime(until)))]
+    if model is not None:
+        where += " AND model = ?"
+        params.append(model)
+    return where, params
+
+def hourly_summary(con:sqlite3.Connection, since:Timestamp, until:Optional[Timestamp]=None,
+                   model:Optional[str]=None) -> list[dict]:
+    """
+    Per hour and model: comment count, mean scores and score histograms, read from the rollup.
+    The window is widened to whole hours.
+
+    Args:
+        con (sqlite3.Connection): connection to the logs database
+        since (datetime | str): start of the window
+        until (datetime | str, optional): end of the window. Defaults to now.
+        model (str, optional): only this model. Defaults to all models.
+
+    Returns:
+        rows (list[dict]): one dict per (hour, model), oldest first
+    """
+    where, params = _rollup_filter(since, until, model)
+    cur = con.execute(f"SELECT {', '.join(_ROLLUP_COLUMNS)} FROM logs_hourly WHERE {where} ORDER BY hour, model", params)
+    rows = []
+    for values in cur:
+        row = dict(zip(_ROLLUP_COLUMNS, values))
+        summary = {"hour": row["hour"], "model": row["model"] or None, "n": row["n"]}
+        for column in SCORE_COLUMNS:
+            prefix = column.split("_")[0]
+            summary[f"mean_{column}"] = row[f"{prefix}_sum"] / row["n"] if row["n"] else None
+            summary[f"{column}_histogram"] = {s: row[f"{prefix}_{s}"] for s in SCORES}
+        rows.append(summary)
+    return rows
+
+def score_histogram(con:sqlite3.Connection, since:Timestamp, until:Optional[Timestamp]=None,
+                    model:Optional[str]=None) -> dict:
+    """
+    Histogram of both scores over a window widened to whole hours, read from the rollup.
+
+    Returns:
+        histogram (dict): {'n': count, 'sentiment_score': {1: n1, ..., 5: n5}, 'offensive_score': {...}}
+    """
+    where, params = _rollup_filter(since, until, model)
+    values = con.execute(f"""
+        SELECT coalesce(sum(n), 0), {", ".join(f"coalesce(sum({column}), 0)" for column in _HISTOGRAM_COLUMNS)}
+        FROM logs_hourly WHERE {where}
+    """, params).fetchone()
+    histogram = {"n": values[0]}
+    bins = iter(values[1:])
+    for column in SCORE_COLUMNS:
+        histogram[column] = {s: next(bins) for s in SCORES}
+    return histogram
+
+def shadow_summary(con:sqlite3.Connection, since:Timestamp, until:Optional[Timestamp]=None) -> dict:
+    """
+    Compare the translate and direct pipelines over the shadow runs logged in a window.
+
+    Args:
+        con (sqlite3.Connection): connection to the logs database
+        since (datetime | str): start of the window
+        until (datetime | str, optional): end of the window. Defaults to now.
+
+    Returns:
+        summary (dict): run count, share of runs where each score and both scores agree, and mean stage latencies in ms
+    """
+    values = con.execute("""
+        SELECT count(*),
+               avg(translate_sentiment_score = direct_sentiment_score),
+               avg(translate_offensive_score = direct_offensive_score),
+               avg(translate_sentiment_score = direct_sentiment_score AND translate_offensive_score = direct_offensive_score),
+               avg(translation_ms), avg(translate_completion_ms), avg(translation_ms + translate_completion_ms),
+               avg(direct_completion_ms)
+        FROM shadow_runs WHERE timestamp >= ? AND timestamp < ?
+    """, (_fmt(_to_datetime(since)), _fmt(_to_datetime(until)))).fetchone()
+    keys = ["runs", "sentiment_agreement", "offensive_agreement", "agreement",
+            "mean_translation_ms", "mean_translate_completion_ms", "mean_translate_total_ms", "mean_direct_total_ms"]
+    return dict(zip(keys, values))
+
+if __name__ == "__main__":
+    from utils import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Summarize the logged scores.")
+    parser.add_argument("--db", default=DB_PATH, help="logs database. Defaults to DB_PATH")
+    parser.add_argument("--hours", type=float, default=24, help="window ending now. Defaults to 24")
+    parser.add_argument("--model", help="only this model")
+    parser.add_argument("--score", choices=SCORE_COLUMNS, default="offensive_score", help="score counted per model")
+    parser.add_argument("--min-score", type=int, default=4, help="lowest score counted per model. Defaults to 4")
+    parser.add_argument("--shadow", action="store_true", help="also compare the translate and direct pipelines")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the hourly rollup from the logs table first")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db)
+    ensure_analytics(con)
+    if args.rebuild:
+        rebuild_rollups(con)
+    since = datetime.now() - timedelta(hours=args.hours)
+    counts = count_by_model(con, since, score=args.score, min_score=args.min_score)
+    if args.model:
+        counts = {args.model: counts.get(args.model, 0)}
+    summary = {
+        f"{args.score} >= {args.min_score} by model": counts,
+        "histogram": score_histogram(con, since, model=args.model),
+    }
+    if args.shadow:
+        summary["shadow"] = shadow_summary(con, since)
+    print(json.dumps(summary, indent=2))
+    con.close()
@@ -0,0 +1,245 @@
+"""
+HTTP scoring service, for production traffic next to the Gradio demo.
+
+Endpoints:
+- POST /score         {"text": "...", "local": false}
+- POST /score/batch   {"texts": ["...", "..."], "local": true, "translator": "nllb", "priority": "bulk"}
+- GET  /healthz       liveness
+- GET  /readyz        readiness, 503 while starting up or draining
+- GET  /metrics       Prometheus metrics, see metrics.py
+
+Scoring runs `sentiment_analyzer` on bounded pools of worker threads, one per priority class,
+so backfills cannot take the threads live requests need. `/score` defaults to "interactive"
+and `/score/batch` to "bulk"; either can be overridden with "priority" and given a
+"deadline_ms", see priority.py. Each class also has its own admission budget, at most
+API_WORKERS + API_MAX_QUEUE interactive and API_BULK_WORKERS + API_BULK_MAX_QUEUE bulk comments
+at once, so a large batch cannot turn live requests away. Requests beyond that are answered with
+429 right away so a load balancer can retry another replica. On shutdown the service stops admitting work, finishes what it admitted and
+flushes the log writers.
+
+Run with:
+    uvicorn api:app --host 0.0.0.0 --port 8000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field, field_validator
+
+from archive import ARCHIVE_ENABLED, start_compaction
+from local_openai_sentiment_analysis import initialize_db, log_writer, sentiment_analyzer, shadow_writer
+from metrics import CONTENT_TYPE, Counter, Gauge, render
+from near_duplicates import get_near_duplicate_index
+from priority import BULK, INTERACTIVE, DeadlineExceeded
+from translators import TRANSLATORS
+from utils import DB_PATH, TRANSLATOR, warm_up
+
+API_WORKERS = int(os.environ.get("API_WORKERS", 8))
+API_BULK_WORKERS = int(os.environ.get("API_BULK_WORKERS", API_WORKERS))
+API_MAX_QUEUE = int(os.environ.get("API_MAX_QUEUE", 64))
+API_BULK_MAX_QUEUE = int(os.environ.get("API_BULK_MAX_QUEUE", API_MAX_QUEUE))
+API_MAX_BATCH = int(os.environ.get("API_MAX_BATCH", 256))
+API_WARM_UP = os.environ.get("API_WARM_UP", "1") == "1"
+API_SHUTDOWN_TIMEOUT = float(os.environ.get("API_SHUTDOWN_TIMEOUT", 30))
+
+logger = logging.getLogger(__name__)
+
+class ScoringOptions(BaseModel):
+    local: bool = False
+    translator: str = TRANSLATOR
+    # Defaults to "interactive" for /score and "bulk" for /score/batch
+    priority: Optional[Literal["interactive", "bulk"]] = None
+    deadline_ms: Optional[float] = Field(default=None, gt=0)
+
+    @field_validator("translator")
+    @classmethod
+    def known_translator(cls, value:str) -> str:
+        if value not in TRANSLATORS:
+            raise ValueError(f"choose from {sorted(TRANSLATORS)}")
+        return value
+
+class ScoreRequest(ScoringOptions):
+    text: str
+
+class BatchScoreRequest(ScoringOptions):
+    texts: list[str] = Field(min_length=1)
+
+class ScoreResponse(BaseModel):
+    sentiment_score: int
+    offensive_score: int
+
+class BatchItem(BaseModel):
+    sentiment_score: Optional[int] = None
+    offensive_score: Optional[int] = None
+    error: Optional[str] = None
+
+class BatchScoreResponse(BaseModel):
+    results: list[BatchItem]
+
+class Admission:
+    """
+    Counts the comments admitted to the worker pool and turns work away once `limit` are pending.
+
+    Args:
+        limit (int): most comments running or waiting at once
+    """
+
+    def __init__(self, limit:int):
+        self.limit = limit
+        self.pending = 0
+        self.draining = False
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.counters = {"admitted": 0, "rejected": 0}
+
+    def try_acquire(self, n:int=1) -> bool:
+        with self._lock:
+            if self.draining or self.pending + n > self.limit:
+                self.counters["rejected"] += n
+                return False
+            self.pending += n
+            self.counters["admitted"] += n
+            return True
+
+    def release(self, n:int=1):
+        with self._lock:
+            self.pending -= n
+            if self.pending == 0:
+                self._idle.notify_all()
+
+    def drain(self, timeout:float) -> bool:
+        """Stop admitting work and wait until everything admitted has finished."""
+        with self._lock:
+            self.draining = True
+            return self._idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, pending=self.pending, limit=self.limit, draining=self.draining)
+
+executors = {
+    INTERACTIVE: ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api-worker"),
+    BULK: ThreadPoolExecutor(max_workers=API_BULK_WORKERS, thread_name_prefix="api-bulk-worker"),
+}
+admissions = {
+    INTERACTIVE: Admission(API_WORKERS + API_MAX_QUEUE),
+    BULK: Admission(API_BULK_WORKERS + API_BULK_MAX_QUEUE),
+}
+
+PENDING = Gauge("api_pending_comments", "Comments admitted and not finished yet.", ("priority",),
+                fn=lambda: {(priority,): admission.stats()["pending"] for priority, admission in admissions.items()})
+REJECTED = Counter("api_rejected_requests_total", "Requests answered with 429.", ("endpoint",))
+_ready = False
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    global _ready
+    initialize_db()
+    get_near_duplicate_index(DB_PATH)
+    if ARCHIVE_ENABLED:
+        start_compaction(DB_PATH)
+    if API_WARM_UP:
+        await asyncio.get_running_loop().run_in_executor(executors[INTERACTIVE], warm_up)
+    _ready = True
+    yield
+    # Uvicorn has stopped accepting connections; let admitted requests finish, then flush the logs
+    _ready = False
+    loop = asyncio.get_running_loop()
+    # Stop admitting to every class before waiting on any of them
+    for admission in admissions.values():
+        admission.draining = True
+    for priority, admission in admissions.items():
+        if not await loop.run_in_executor(None, admission.drain, API_SHUTDOWN_TIMEOUT):
+            logger.warning(f"Shutting down with {admission.stats()['pending']} {priority} comments still pending")
+    for executor in executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    log_writer.close()
+    shadow_writer.close()
+
+app = FastAPI(title="Social Media Analysis", lifespan=lifespan)
+
+def _saturated() -> JSONResponse:
+    return JSONResponse({"detail": "Too many pending comments, retry later"}, status_code=429, headers={"Retry-After": "1"})
+
+def _deadline(request:ScoringOptions) -> Optional[float]:
+    return time.monotonic() + request.deadline_ms / 1000 if request.deadline_ms else None
+
+async def _score(text:str, local:bool, translator:str, priority:str, deadline:Optional[float]) -> tuple:
+    return await asyncio.get_running_loop().run_in_executor(executors[priority], sentiment_analyzer, text, local, translator,
+                                                            priority, deadline)
+
+@app.post("/score", response_model=ScoreResponse)
+async def score(request:ScoreRequest):
+    priority = request.priority or INTERACTIVE
+    admission = admissions[priority]
+    if not admission.try_acquire():
+        REJECTED.inc(endpoint="/score")
+        return _saturated()
+    try:
+        sentiment, offensive = await _score(request.text, request.local, request.translator, priority, _deadline(request))
+    except DeadlineExceeded as e:
+        return JSONResponse({"detail": str(e)}, status_code=503, headers={"Retry-After": "1"})
+    except Exception as e:
+        logger.error(f"Scoring failed: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        admission.release()
+    return ScoreResponse(sentiment_score=sentiment, offensive_score=offensive)
+
+@app.post("/score/batch", response_model=BatchScoreResponse)
+async def score_batch(request:BatchScoreRequest):
+    n = len(request.texts)
+    priority, deadline = request.priority or BULK, _deadline(request)
+    admission = admissions[priority]
+    # A batch larger than the admission limit could never be admitted, so retrying it is pointless
+    max_batch = min(API_MAX_BATCH, admission.limit)
+    if n > max_batch:
+        raise HTTPException(status_code=413, detail=f"At most {max_batch} texts per batch")
+    # All or nothing, so a batch is never half scored because of backpressure
+    if not admission.try_acquire(n):
+        REJECTED.inc(endpoint="/score/batch")
+        return _saturated()
+    try:
+        outcomes = await asyncio.gather(*(_score(text, request.local, request.translator, priority, deadline)
+                                          for text in request.texts), return_exceptions=True)
+    finally:
+        admission.release(n)
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            results.append(BatchItem(error=str(outcome)))
+        else:
+            results.append(BatchItem(sentiment_score=outcome[0], offensive_score=outcome[1]))
+    return BatchScoreResponse(results=results)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render(), media_type=CONTENT_TYPE)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    stats = {priority: admission.stats() for priority, admission in admissions.items()}
+    if not _ready or any(admission["draining"] for admission in stats.values()):
+        return JSONResponse({"status": "not ready", **stats}, status_code=503)
+    return {"status": "ready", **stats}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the scoring API.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, timeout_graceful_shutdown=API_SHUTDOWN_TIMEOUT)
@@ -0,0 +1,221 @@
+"""
+Move old rows of the `logs` table into a date-partitioned Parquet archive.
+
+`compact` copies the rows older than ARCHIVE_RETENTION_DAYS, whole days at a time, into
+`<ARCHIVE_DIR>/date=YYYY-MM-DD/part-<first id>-<last id>-<first time>.parquet`. It then deletes them from
+SQLite in short transactions, so the log writer is never blocked for long, and frees the pages.
+`model` is dictionary encoded and the scores are stored as int8. The `logs_hourly` rollup
+is left alone, so dashboards keep counting archived hours.
+
+A file is written in full before its rows are deleted. If the job stops in between, the next run
+archives the same rows again; `read_archive` drops such duplicates by `id` and `timestamp`.
+`logs.ID` is not AUTOINCREMENT, so SQLite may hand out archived ids again once compaction has
+emptied the table; the timestamp tells those rows apart. Reads memory-map
+the files and only open the partitions inside the requested window.
+
+Needs `pip install pyarrow`. Run once with:
+    python archive.py --db ../logs.db --retention-days 30
+or set ARCHIVE_ENABLED=1 to compact in the background of the app and the API.
+"""
+import argparse
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Optional, Union
+
+from log_writer import tune_connection
+
+ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "0") == "1"
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "../logs_archive")
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", 30))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", 24))
+# Rows archived and deleted per transaction
+ARCHIVE_BATCH_ROWS = int(os.environ.get("ARCHIVE_BATCH_ROWS", 50_000))
+
+COLUMNS = ("id", "input", "model", "eng_input", "sentiment_score", "offensive_score", "timestamp")
+
+logger = logging.getLogger(__name__)
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The logs archive needs `pip install pyarrow`") from e
+    return pyarrow, pyarrow.parquet
+
+def archive_schema():
+    """Arrow schema of the archived rows."""
+    pa, _ = _pyarrow()
+    return pa.schema([
+        ("id", pa.int64()),
+        ("input", pa.string()),
+        ("model", pa.dictionary(pa.int16(), pa.string())),
+        ("eng_input", pa.string()),
+        ("sentiment_score", pa.int8()),
+        ("offensive_score", pa.int8()),
+        ("timestamp", pa.timestamp("ms")),
+    ])
+
+def _to_table(rows:list[tuple]):
+    pa, _ = _pyarrow()
+    ids, inputs, models, eng_inputs, sentiments, offensives, timestamps = zip(*rows)
+    schema = archive_schema()
+    arrays = [
+        pa.array(ids, pa.int64()),
+        pa.array(inputs, pa.string()),
+        pa.array(models, pa.string()).dictionary_encode().cast(schema.field("model").type),
+        pa.array(eng_inputs, pa.string()),
+        pa.array(sentiments, pa.int8()),
+        pa.array(offensives, pa.int8()),
+        pa.array([datetime.fromisoformat(value) if value else None for value in timestamps], pa.timestamp("ms")),
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def _write_partition(archive_dir:str, day:str, rows:list[tuple]) -> str:
+    _, pq = _pyarrow()
+    directory = os.path.join(archive_dir, f"date={day}")
+    os.makedirs(directory, exist_ok=True)
+    # The time of day keeps reused ids from overwriting an earlier file of the same day
+    first_time = rows[0][6][11:19].replace(":", "")
+    name = f"part-{rows[0][0]}-{rows[-1][0]}-{first_time}.parquet"
+    path = os.path.join(directory, name)
+    # pyarrow skips dot files when reading a directory, so a half-written
+    # (or crashed) temp file never becomes part of the archive
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    pq.write_table(_to_table(rows), tmp_path, compression="zstd", use_dictionary=["model"])
+    os.replace(tmp_path, path)
+    return path
+
+def compact(db_path:str, archive_dir:str=ARCHIVE_DIR, retention_days:int=ARCHIVE_RETENTION_DAYS,
+            batch_rows:int=ARCHIVE_BATCH_ROWS, vacuum:bool=False) -> dict:
+    """
+    Archive and delete the rows of the logs table older than the retention window.
+
+    Args:
+        db_path (str): SQLite database holding the logs table
+        archive_dir (str, optional): root of the Parquet archive. Defaults to ARCHIVE_DIR.
+        retention_days (int, optional): full days of rows kept in SQLite. Defaults to ARCHIVE_RETENTION_DAYS.
+        batch_rows (int, optional): rows archived and deleted per transaction. Defaults to ARCHIVE_BATCH_ROWS.
+        vacuum (bool, optional): switch the database to incremental auto-vacuum with a full VACUUM first.
+            It rewrites the whole file and blocks writers meanwhile, so it is only needed once. Defaults to False.
+
+    Returns:
+        stats (dict): rows archived, files written and pages freed
+    """
+    cutoff = datetime.combine(date.today() - timedelta(days=retention_days), datetime.min.time())
+    cutoff = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+    con = sqlite3.connect(db_path)
+    tune_connection(con)
+    stats = {"rows": 0, "files": 0, "freed_pages": 0}
+    # Temp files left behind by a run that died mid-write
+    for tmp_path in glob.glob(os.path.join(archive_dir, "date=*", ".*.tmp")):
+        os.remove(tmp_path)
+    try:
+        last_id = -1
+        while True:
+            rows = con.execute(f"""
+                SELECT {", ".join(COLUMNS)} FROM logs
+                WHERE timestamp < ? AND ID > ? ORDER BY ID LIMIT ?
+            """, (cutoff, last_id, batch_rows)).fetchall()
+            if not rows:
+                break
+            by_day = {}
+            for row in rows:
+                by_day.setdefault(row[6][:10], []).append(row)
+            for day, day_rows in sorted(by_day.items()):
+                _write_partition(archive_dir, day, day_rows)
+                stats["files"] += 1
+            first_id, last_id = rows[0][0], rows[-1][0]
+            with con:
+                con.execute("DELETE FROM logs WHERE ID BETWEEN ? AND ? AND timestamp < ?", (first_id, last_id, cutoff))
+            stats["rows"] += len(rows)
+
+        auto_vacuum = con.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if vacuum and auto_vacuum != 2:
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute("VACUUM")
+        elif auto_vacuum == 0:
+            logger.warning(f"{db_path} was created without auto-vacuum, so it will not shrink. "
+                           "Run `python archive.py --vacuum` once while the app is stopped.")
+        free_pages = con.execute("PRAGMA freelist_count").fetchone()[0]
+        # Returns the free pages to the file system; a no-op unless auto_vacuum is INCREMENTAL
+        con.execute("PRAGMA incremental_vacuum").fetchall()
+        stats["freed_pages"] = free_pages - con.execute("PRAGMA freelist_count").fetchone()[0]
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        con.close()
+    logger.info(f"Archived {stats['rows']} log rows older than {cutoff} into {stats['files']} files")
+    return stats
+
+def read_archive(archive_dir:str=ARCHIVE_DIR, since:Optional[Union[date, str]]=None, until:Optional[Union[date, str]]=None,
+                 columns:Optional[list[str]]=None):
+    """
+    Read archived rows through memory-mapped files.
+
+    Args:
+        archive_dir (str, optional): root of the Parquet archive. Defaults to ARCHIVE_DIR.
+        since (date | str, optional): first day to read, e.g. "2024-05-01". Defaults to the oldest partition.
+        until (date | str, optional): first day not to read. Defaults to the newest partition.
+        columns (list[str], optional): columns to read. Defaults to all of COLUMNS.
+
+    Returns:
+        table (pyarrow.Table): archived rows with a `date` column, each (`id`, `timestamp`) once
+    """
+    pa, pq = _pyarrow()
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    filters = []
+    if since is not None:
+        filters.append(("date", ">=", str(since)))
+    if until is not None:
+        filters.append(("date", "<", str(until)))
+    partitioning = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+    read_columns = None if columns is None else list(dict.fromkeys(["id", "timestamp"] + columns))
+    table = pq.read_table(archive_dir, columns=read_columns, filters=filters or None, partitioning=partitioning,
+                          memory_map=True)
+    if table.num_rows > 1:
+        # Rows archived twice by an interrupted run share their id and timestamp; keep the first copy
+        table = table.sort_by([("id", "ascending"), ("timestamp", "ascending")])
+        ids, timestamps = table["id"].combine_chunks(), table["timestamp"].combine_chunks()
+        n = table.num_rows
+        repeated = pc.and_(pc.equal(ids.slice(1), ids.slice(0, n - 1)),
+                           pc.equal(timestamps.slice(1), timestamps.slice(0, n - 1)))
+        table = table.filter(pa.concat_arrays([pa.array([True]), pc.invert(pc.fill_null(repeated, False))]))
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+def start_compaction(db_path:str, interval_hours:float=ARCHIVE_INTERVAL_HOURS) -> threading.Thread:
+    """Run `compact` every `interval_hours` in a daemon thread, starting now."""
+
+    def run():
+        while True:
+            try:
+                compact(db_path)
+            except Exception as e:
+                logger.error(f"Log compaction failed: {e}")
+            time.sleep(interval_hours * 3600)
+
+    thread = threading.Thread(target=run, name="log-compaction", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    from utils import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Move old log rows into the Parquet archive.")
+    parser.add_argument("--db", default=DB_PATH, help="logs database. Defaults to DB_PATH")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="archive root. Defaults to ARCHIVE_DIR")
+    parser.add_argument("--retention-days", type=int, default=ARCHIVE_RETENTION_DAYS,
+                        help="full days of rows kept in SQLite. Defaults to ARCHIVE_RETENTION_DAYS")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="switch the database to incremental auto-vacuum first; rewrites the file once")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(compact(args.db, args.archive_dir, args.retention_days, vacuum=args.vacuum))
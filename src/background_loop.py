@@ -0,0 +1,31 @@
+import asyncio
+import threading
+from typing import Coroutine, Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared event loop, starting its daemon thread on first use."""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="background-loop", daemon=True).start()
+        return _loop
+
+def run_coroutine(coro:Coroutine, timeout:Optional[float]=None):
+    """
+    Run a coroutine on the shared background event loop and block until it finishes.
+
+    Lets synchronous callers (Gradio handlers, the bulk CLI) share async clients, their
+    connection pools and rate limiters, which must all live on a single event loop.
+
+    Args:
+        coro (Coroutine): coroutine to run
+        timeout (float, optional): seconds to wait for the result. Defaults to None.
+
+    Returns:
+        result: return value of the coroutine
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
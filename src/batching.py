@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
+
+
+class MicroBatcher:
+    """
+    Collect concurrent single-item calls into batches and run them through one batch function.
+
+    Callers block in `submit` while a background thread groups pending items into batches of
+    at most `max_batch_size`, waiting at most `max_wait_ms` after the first item arrives.
+    Each caller gets back only the result at its own position in the batch.
+
+    Args:
+        batch_fn (Callable[[List], List]): function mapping a list of items to a list of results of the same length
+        max_batch_size (int, optional): largest batch handed to `batch_fn`. Defaults to 8.
+        max_wait_ms (float, optional): how long to wait for more items once a batch is started. Defaults to 10.
+        name (str, optional): name of the worker thread. Defaults to "micro-batcher".
+        concurrency (int, optional): batches run at the same time, e.g. one per worker process behind `batch_fn`. Defaults to 1.
+    """
+
+    def __init__(self, batch_fn:Callable[[List], List], max_batch_size:int=8, max_wait_ms:float=10, name:str="micro-batcher",
+                 concurrency:int=1):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        # The next batch is only collected once a slot is free, so it keeps filling meanwhile
+        self._slots = threading.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name) if concurrency > 1 else None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+        Queue a single item and block until its batch has been processed.
+
+        Args:
+            item: single input for `batch_fn`
+
+        Returns:
+            result: output of `batch_fn` for this item
+        """
+        return self.submit_async(item).result()
+
+    def submit_async(self, item) -> Future:
+        """Queue a single item and return a Future resolved with its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            batch = self._collect()
+            if self._executor is None:
+                self._process(batch)
+            else:
+                self._executor.submit(self._process, batch)
+
+    def _process(self, batch:list):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"batch_fn returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
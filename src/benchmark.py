@@ -0,0 +1,290 @@
+"""
+Benchmark the translate -> prompt -> score pipeline stage by stage.
+
+Runs the same steps as `local_openai_sentiment_analysis.sentiment_analyzer` against a local
+stub LLM server (see fake_llm_server.py) and a throwaway SQLite file, and reports latency
+percentiles per stage, end-to-end throughput and peak RSS as JSON. Needs no network and no
+GPU; use `--translator stub` to also skip loading a translation model.
+
+`--ttft` instead measures the time to the first token of local completions for three prompt
+layouts: the instructions and comment in one prompt ("inline"), the instructions as a stable
+system prompt ("prefix"), and the same with a system prompt that changes on every call, so no
+evaluated context can be reused ("uncached"). The inline layout already starts every prompt with
+the same instructions, so the saving reported is inline minus prefix; "uncached" only shows what
+prompt evaluation costs when nothing is reused. The stub server only models prompt evaluation
+with `--prompt-token-ms`; point `--llm-url` at a real Ollama server for real numbers.
+
+Examples:
+    python benchmark.py --backend local --requests 200 --concurrency 8 --output ../benchmark.json
+    python benchmark.py --backend openai --translator stub --baseline ../benchmark.json
+    python benchmark.py --ttft --requests 50 --prompt-token-ms 0.5 --output ../ttft.json
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from background_loop import run_coroutine
+from fake_llm_server import start_fake_llm_server
+from local_openai_sentiment_analysis import SYSTEM_PROMPT, build_comment_prompt, build_prompt, initialize_db, insert_logs
+from log_writer import LogWriter
+from structured_output import parse_scores
+from translators import CHECK_SENTENCES, TRANSLATORS
+from utils import get_local_completion, stream_local_completion, translate_tr_to_eng
+
+# "db_submit" is the time a request spends handing its row to the log writer, "db_write" the
+# time the writer takes to insert and commit one group of rows
+STAGES = ["translation", "prompt", "completion", "parse", "db_submit", "db_write", "end_to_end"]
+PROMPT_LAYOUTS = ["inline", "prefix", "uncached"]
+
+def percentiles(samples:list[float]) -> dict:
+    """
+    Summarize latency samples given in seconds.
+
+    Args:
+        samples (list[float]): latencies in seconds
+
+    Returns:
+        summary (dict): count, mean, p50, p95, p99 and max in milliseconds
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def make_translate(translator:str, stub_ms:float):
+    if translator == "stub":
+        def translate(article):
+            time.sleep(stub_ms / 1000)
+            return article
+        return translate
+    return lambda article: translate_tr_to_eng(article, translator=translator)
+
+def make_complete(backend:str, base_url:str, model:str):
+    if backend == "local":
+        return lambda prompt: get_local_completion(prompt, model=model, url=f"{base_url}/api/generate",
+                                                     stop_when_scored=True, structured=True, system=SYSTEM_PROMPT)
+
+    # Point the OpenAI SDK at the given server before the backend builds its client
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    from openai_client import AsyncOpenAIBackend
+    openai_backend = AsyncOpenAIBackend(model=model)
+    return lambda prompt: run_coroutine(openai_backend.complete(prompt, system=SYSTEM_PROMPT))
+
+def run_one(comment:str, translate, complete, log_writer:LogWriter, model:str, is_local:bool) -> dict:
+    """Run one comment through every stage and return the seconds spent in each."""
+    timings = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    comment_eng = translate(comment) if is_local else None
+    timings["translation"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    prompt = build_comment_prompt(comment_eng if is_local else comment)
+    timings["prompt"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    response = complete(prompt)
+    timings["completion"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    res_dict = parse_scores(response)
+    timings["parse"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    log_writer.submit((comment, model, comment_eng, res_dict["sentiment_score"], res_dict["offensive_score"]))
+    timings["db_submit"] = time.perf_counter() - t
+
+    timings["end_to_end"] = time.perf_counter() - start
+    return timings
+
+def run_benchmark(args) -> dict:
+    """
+    Run the benchmark described by the parsed command line arguments.
+
+    Returns:
+        report (dict): configuration, per-stage percentiles, throughput and peak RSS
+    """
+    server = None
+    base_url = args.llm_url
+    if base_url is None:
+        server = start_fake_llm_server(first_token_ms=args.first_token_ms, token_ms=args.token_ms)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    is_local = args.backend == "local"
+    translate = make_translate(args.translator, args.stub_translation_ms)
+    complete = make_complete(args.backend, base_url, args.model)
+    comments = [CHECK_SENTENCES[i % len(CHECK_SENTENCES)] for i in range(args.requests)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "benchmark_logs.db")
+        initialize_db(db_path)
+        write_seconds = []
+
+        def timed_insert_logs(con, rows):
+            t = time.perf_counter()
+            insert_logs(con, rows)
+            write_seconds.append(time.perf_counter() - t)
+
+        log_writer = LogWriter(db_path, timed_insert_logs)
+
+        for comment in comments[:args.warmup]:
+            run_one(comment, translate, complete, log_writer, args.model, is_local)
+        write_seconds.clear()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda c: run_one(c, translate, complete, log_writer, args.model, is_local), comments))
+        wall_seconds = time.perf_counter() - start
+        log_writer.close()
+
+    if server is not None:
+        server.shutdown()
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "stages": {stage: percentiles(write_seconds if stage == "db_write" else [r[stage] for r in results])
+                   for stage in STAGES},
+        "wall_seconds": wall_seconds,
+        "throughput_per_s": len(results) / wall_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "log_writer": log_writer.stats(),
+    }
+
+def time_to_first_token(comment:str, layout:str, url:str, model:str) -> float:
+    """Seconds until the first token of a local completion arrives, for one of PROMPT_LAYOUTS."""
+    if layout == "inline":
+        prompt, system = build_prompt(comment), None
+    elif layout == "prefix":
+        prompt, system = build_comment_prompt(comment), SYSTEM_PROMPT
+    else:
+        # A different first line every call, so nothing evaluated before can be reused
+        prompt, system = build_comment_prompt(comment), f"Request {uuid.uuid4().hex}.\n{SYSTEM_PROMPT}"
+    start = time.perf_counter()
+    for extractor in stream_local_completion(prompt, model=model, url=url, structured=True, system=system):
+        if extractor.text:
+            break
+    return time.perf_counter() - start
+
+def run_ttft_benchmark(args) -> dict:
+    """
+    Compare the time to first token of the prompt layouts, one request at a time.
+
+    Returns:
+        report (dict): configuration, TTFT percentiles per layout and the TTFT saved per request
+            by the system prompt over the inline layout
+    """
+    server = None
+    base_url = args.llm_url
+    if base_url is None:
+        server = start_fake_llm_server(first_token_ms=args.first_token_ms, token_ms=args.token_ms,
+                                       prompt_token_ms=args.prompt_token_ms)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+    url = f"{base_url}/api/generate"
+    comments = [CHECK_SENTENCES[i % len(CHECK_SENTENCES)] for i in range(args.requests)]
+
+    samples = {layout: [] for layout in PROMPT_LAYOUTS}
+    for layout in PROMPT_LAYOUTS:
+        for comment in comments[:args.warmup]:
+            time_to_first_token(comment, layout, url, args.model)
+        for comment in comments:
+            samples[layout].append(time_to_first_token(comment, layout, url, args.model))
+
+    if server is not None:
+        server.shutdown()
+
+    ttft = {layout: percentiles(values) for layout, values in samples.items()}
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "ttft": ttft,
+        "saved_ms_per_request": ttft["inline"]["mean_ms"] - ttft["prefix"]["mean_ms"],
+    }
+
+def compare_to_baseline(report:dict, baseline:dict, max_regression:float) -> list[str]:
+    """
+    List the stages whose p95 latency grew by more than `max_regression` (a fraction) over the baseline.
+
+    Args:
+        report (dict): current benchmark report
+        baseline (dict): earlier report from the same machine and configuration
+        max_regression (float): allowed relative growth, e.g. 0.2 for 20%
+
+    Returns:
+        regressions (list[str]): human readable regression messages, empty when there are none
+    """
+    regressions = []
+    for stage, summary in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage, {}).get("p95_ms")
+        after = summary.get("p95_ms")
+        # Ignore sub-millisecond stages, their p95 is mostly noise
+        if before and after and after > 1 and after > before * (1 + max_regression):
+            regressions.append(f"{stage}: p95 {before:.1f}ms -> {after:.1f}ms")
+    if report["throughput_per_s"] < baseline.get("throughput_per_s", 0) * (1 - max_regression):
+        regressions.append(f"throughput: {baseline['throughput_per_s']:.1f}/s -> {report['throughput_per_s']:.1f}/s")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sentiment analysis pipeline against a stub LLM server.")
+    parser.add_argument("--backend", choices=["local", "openai"], default="local", help="completion path to benchmark")
+    parser.add_argument("--translator", default="stub", choices=["stub"] + sorted(TRANSLATORS),
+                        help="translator for the local path; 'stub' sleeps --stub-translation-ms instead. Defaults to stub")
+    parser.add_argument("--stub-translation-ms", type=float, default=0, help="latency of the stub translator")
+    parser.add_argument("--llm-url", help="benchmark against this server instead of the built-in stub")
+    parser.add_argument("--model", default="fake", help="model name sent to the LLM server. Defaults to 'fake'")
+    parser.add_argument("--first-token-ms", type=float, default=50, help="stub server latency before the first token")
+    parser.add_argument("--token-ms", type=float, default=10, help="stub server latency per following token")
+    parser.add_argument("--prompt-token-ms", type=float, default=0,
+                        help="stub server latency per prompt token it cannot reuse from the previous prompt")
+    parser.add_argument("--ttft", action="store_true", help="compare the time to first token of the prompt layouts instead")
+    parser.add_argument("--requests", type=int, default=100, help="comments to score. Defaults to 100")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed comments run first. Defaults to 5")
+    parser.add_argument("--concurrency", type=int, default=1, help="comments in flight at once. Defaults to 1")
+    parser.add_argument("--output", default="../benchmark.json", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="earlier JSON report; exit non-zero when this run regresses")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95/throughput regression. Defaults to 0.2")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.ttft:
+        report = run_ttft_benchmark(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report["ttft"], indent=2))
+        print(f"time to first token saved per request over the inline prompt: {report['saved_ms_per_request']:.1f} ms")
+    else:
+        report = run_benchmark(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report["stages"], indent=2))
+        print(f"throughput: {report['throughput_per_s']:.1f}/s, peak RSS: {report['peak_rss_mb']:.0f} MiB")
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(report, json.load(f), args.max_regression)
+            if regressions:
+                raise SystemExit("Regressions against baseline:\n" + "\n".join(regressions))
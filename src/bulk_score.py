@@ -0,0 +1,257 @@
+"""
+Offline bulk scoring of archived Turkish comments.
+
+Reads a CSV or JSONL dump lazily, translates and scores it chunk by chunk with the same
+prompt and parsing as `local_openai_sentiment_analysis.sentiment_analyzer`, and writes the
+results in input order as JSONL or as a directory of Parquet parts. Progress is recorded in
+a checkpoint file after every chunk so an interrupted run can be resumed.
+
+Example:
+    python bulk_score.py comments.csv scores.jsonl --text-column text --local --chunk-size 64
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+from itertools import islice
+from typing import Callable, Iterator, Optional
+
+from background_loop import run_coroutine
+from cache import cache_key
+from local_openai_sentiment_analysis import (
+    PROMPT_VERSION,
+    SYSTEM_PROMPT,
+    build_comment_prompt,
+    get_db_connection,
+    initialize_db,
+    insert_logs,
+    logger,
+    result_cache,
+)
+from ollama_client import AsyncOllamaClient
+from openai_client import AsyncOpenAIBackend
+from packing import LOCAL_PACK_SIZE, OPENAI_PACK_SIZE, complete_packed
+from structured_output import parse_scores, structured_request_fields
+from translators import TRANSLATORS, translator_id
+from utils import (
+    LOCAL_MODEL,
+    OPENAI_MODEL,
+    PIPELINE_MODE,
+    TRANSLATE_MAX_BATCH_SIZE,
+    TRANSLATOR,
+    translate_batch,
+)
+
+
+def read_records(path:str, fmt:str) -> Iterator[dict]:
+    """
+    Lazily yield records from a CSV or JSONL file, one at a time.
+
+    Args:
+        path (str): input file path
+        fmt (str): "csv" or "jsonl"
+
+    Yields:
+        record (dict): one input row
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def load_checkpoint(path:str) -> dict:
+    """Return the saved checkpoint, or an empty one when starting from scratch."""
+    if not os.path.exists(path):
+        return {"rows_done": 0, "output_bytes": 0, "parts": 0}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path:str, checkpoint:dict):
+    """Atomically replace the checkpoint file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def translate_texts(texts:list[str], translator:str=TRANSLATOR) -> list[str]:
+    """Translate texts missing from the cache in slices of at most TRANSLATE_MAX_BATCH_SIZE per generate call."""
+    keys = [cache_key("translation", text, translator_id(translator)) for text in texts]
+    eng = [result_cache.get(key) for key in keys]
+    missing = [i for i, value in enumerate(eng) if value is None]
+    for start in range(0, len(missing), TRANSLATE_MAX_BATCH_SIZE):
+        batch = missing[start:start + TRANSLATE_MAX_BATCH_SIZE]
+        for i, value in zip(batch, translate_batch([texts[i] for i in batch], translator=translator)):
+            eng[i] = value
+            result_cache.set(keys[i], value)
+    return eng
+
+def score_chunk(texts:list[str], is_local:bool, complete_many:Callable[..., list], pack_size:int=1,
+                translator:str=TRANSLATOR) -> list[dict]:
+    """
+    Translate (local only) and score a chunk of comments.
+
+    Args:
+        texts (list[str]): turkish comments
+        is_local (bool): use the local Ollama model instead of OpenAI
+        complete_many (Callable[..., list]): sends prompts concurrently with an optional `system` prompt,
+            returning a response or exception per prompt
+        pack_size (int, optional): comments scored per LLM call, 1 disables packing. Defaults to 1.
+        translator (str, optional): translator used with the local model. Defaults to the TRANSLATOR env var.
+
+    Returns:
+        results (list[dict]): one result per comment, in input order
+    """
+    if is_local and PIPELINE_MODE == "direct":
+        eng_texts = [None] * len(texts)
+        comments, model = texts, LOCAL_MODEL
+    elif is_local:
+        eng_texts = translate_texts(texts, translator)
+        comments, model = eng_texts, LOCAL_MODEL
+    else:
+        eng_texts = [None] * len(texts)
+        comments, model = texts, OPENAI_MODEL
+
+    keys = [cache_key("completion", comment, model, PROMPT_VERSION) for comment in comments]
+    responses = [result_cache.get(key) for key in keys]
+    missing = [i for i, response in enumerate(responses) if response is None]
+    if pack_size > 1:
+        missing_responses = complete_packed([comments[i] for i in missing], complete_many, pack_size)
+    else:
+        # Same layout as sentiment_analyzer, so the cached completions of both are interchangeable
+        missing_responses = complete_many([build_comment_prompt(comments[i]) for i in missing], system=SYSTEM_PROMPT)
+    for i, response in zip(missing, missing_responses):
+        responses[i] = response
+
+    results = []
+    for i, (text, eng, response) in enumerate(zip(texts, eng_texts, responses)):
+        sentiment = offensive = error = None
+        try:
+            if isinstance(response, Exception):
+                raise response
+            res_dict = parse_scores(response)
+            sentiment, offensive = res_dict["sentiment_score"], res_dict["offensive_score"]
+            if i in missing:
+                result_cache.set(keys[i], json.dumps(res_dict))
+        except Exception as e:
+            logger.error(e)
+            error = str(e)
+        results.append({
+            "input": text, "model": model, "eng_input": eng,
+            "sentiment_score": sentiment, "offensive_score": offensive, "error": error,
+        })
+    return results
+
+def write_jsonl(path:str, results:list[dict]) -> int:
+    """Append results to a JSONL file and return the new file size in bytes."""
+    with open(path, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+def write_parquet_part(directory:str, part:int, results:list[dict]):
+    """Write one chunk of results as its own Parquet file in `directory`."""
+    import pandas as pd
+    os.makedirs(directory, exist_ok=True)
+    pd.DataFrame(results).to_parquet(os.path.join(directory, f"part-{part:05d}.parquet"), index=False)
+
+def prepare_output(args, checkpoint:dict):
+    """Drop any output written after the last checkpoint so a resumed run does not duplicate rows."""
+    if args.output_format == "jsonl":
+        if os.path.exists(args.output):
+            with open(args.output, "r+b") as f:
+                f.truncate(checkpoint["output_bytes"])
+    elif os.path.isdir(args.output):
+        for name in os.listdir(args.output):
+            if name.startswith("part-") and int(name[5:10]) >= checkpoint["parts"]:
+                os.remove(os.path.join(args.output, name))
+
+def run(args):
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.json"
+    checkpoint = load_checkpoint(checkpoint_path)
+    prepare_output(args, checkpoint)
+    if checkpoint["rows_done"]:
+        logger.info(f"Resuming bulk scoring after {checkpoint['rows_done']} rows")
+
+    records = islice(read_records(args.input, args.input_format), checkpoint["rows_done"], None)
+    if args.log_db:
+        initialize_db()
+
+    if args.local:
+        backend = AsyncOllamaClient(concurrency=args.workers)
+    else:
+        backend = AsyncOpenAIBackend(concurrency=args.workers)
+
+    # Single-comment prompts can be constrained to the score schema, packed ones cannot
+    options = structured_request_fields() if args.local and args.pack_size == 1 else {}
+
+    def complete_many(prompts:list[str], system:Optional[str]=None) -> list:
+        return run_coroutine(backend.gather(prompts, **options) if system is None else
+                             backend.gather(prompts, system=system, **options))
+
+    while True:
+        chunk = list(islice(records, args.chunk_size))
+        if not chunk:
+            break
+        texts = [str(record.get(args.text_column) or "") for record in chunk]
+        results = score_chunk(texts, args.local, complete_many, args.pack_size, args.translator)
+        for i, (record, result) in enumerate(zip(chunk, results)):
+            result["row"] = checkpoint["rows_done"] + i
+            if args.id_column:
+                result["id"] = record.get(args.id_column)
+
+        if args.output_format == "jsonl":
+            checkpoint["output_bytes"] = write_jsonl(args.output, results)
+        else:
+            write_parquet_part(args.output, checkpoint["parts"], results)
+            checkpoint["parts"] += 1
+
+        if args.log_db:
+            rows = [(r["input"], r["model"], r["eng_input"], r["sentiment_score"], r["offensive_score"])
+                    for r in results if r["error"] is None]
+            with get_db_connection() as con:
+                insert_logs(con, rows)
+
+        checkpoint["rows_done"] += len(chunk)
+        save_checkpoint(checkpoint_path, checkpoint)
+        logger.info(f"Scored {checkpoint['rows_done']} rows, cache: {result_cache.stats()}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score a CSV/JSONL dump of Turkish comments in bulk.")
+    parser.add_argument("input", help="input CSV or JSONL file")
+    parser.add_argument("output", help="output JSONL file, or output directory for Parquet")
+    parser.add_argument("--input-format", choices=["csv", "jsonl"], help="defaults to the input file extension")
+    parser.add_argument("--output-format", choices=["jsonl", "parquet"], help="defaults to the output file extension")
+    parser.add_argument("--text-column", default="text", help="column/key holding the comment. Defaults to 'text'")
+    parser.add_argument("--id-column", help="optional column/key copied to the output as 'id'")
+    parser.add_argument("--local", action="store_true",
+                        help="score with the local Ollama model, translating first unless PIPELINE_MODE=direct")
+    parser.add_argument("--translator", default=TRANSLATOR, choices=sorted(TRANSLATORS),
+                        help="translator used with --local unless PIPELINE_MODE=direct")
+    parser.add_argument("--chunk-size", type=int, default=64, help="rows held in memory at once. Defaults to 64")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent completion requests. Defaults to 4")
+    parser.add_argument("--pack-size", type=int, help="comments per LLM call, 1 disables packing. Defaults to LOCAL_PACK_SIZE/OPENAI_PACK_SIZE")
+    parser.add_argument("--checkpoint", help="checkpoint file. Defaults to <output>.checkpoint.json")
+    parser.add_argument("--log-db", action="store_true", help="also insert successful rows into the logs table")
+    args = parser.parse_args(argv)
+
+    if args.input_format is None:
+        args.input_format = "csv" if args.input.endswith(".csv") else "jsonl"
+    if args.output_format is None:
+        args.output_format = "jsonl" if args.output.endswith(".jsonl") else "parquet"
+    if args.pack_size is None:
+        args.pack_size = LOCAL_PACK_SIZE if args.local else OPENAI_PACK_SIZE
+    return args
+
+if __name__ == "__main__":
+    # The pipeline logger only writes to the log file; report progress on the terminal too
+    logger.addHandler(logging.StreamHandler())
+    run(parse_args())
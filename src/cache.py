@@ -0,0 +1,186 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from log_writer import tune_connection
+from metrics import Counter
+
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "1") == "1"
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 7 * 24 * 3600))
+CACHE_MEMORY_ENTRIES = int(os.environ.get("CACHE_MEMORY_ENTRIES", 10_000))
+CACHE_DISK_ENTRIES = int(os.environ.get("CACHE_DISK_ENTRIES", 1_000_000))
+
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Result cache lookups by outcome.", ("namespace", "result"))
+
+_RETWEET_PREFIX = re.compile(r"^(rt\s+)?(@\w+:?\s*)+")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text:str) -> str:
+    """
+    Normalize a comment so trivially different copies map to the same cache key.
+    Applies NFKC, lowercasing, whitespace collapsing and drops a leading "RT @user:" prefix.
+
+    Args:
+        text (str): raw comment
+
+    Returns:
+        normalized (str): normalized comment
+    """
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    normalized = _WHITESPACE.sub(" ", normalized).strip()
+    normalized = _RETWEET_PREFIX.sub("", normalized)
+    return normalized
+
+def cache_key(namespace:str, text:str, model:str, version:str="") -> str:
+    """
+    Build a content-addressed cache key.
+
+    Args:
+        namespace (str): pipeline step, e.g. "translation" or "completion"
+        text (str): input of the step, normalized before hashing
+        model (str): model name the step runs with
+        version (str, optional): prompt template version. Defaults to "".
+
+    Returns:
+        key (str): sha256 hex digest prefixed with the namespace
+    """
+    digest = hashlib.sha256("\x1f".join([normalize_text(text), str(model), version]).encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+class ResultCache:
+    """
+    Two-tier cache: an in-process LRU in front of a SQLite table.
+
+    Entries expire after `ttl_seconds`. The memory tier keeps at most `max_memory_entries`
+    keys, the disk tier is trimmed to `max_disk_entries` by last access time. Lookups never
+write: access times of disk hits are collected and saved with the next `set`, or once
+TOUCH_BATCH of them are pending, and expired rows are only deleted when the table is pruned.
+
+    Args:
+        db_path (str): SQLite database file, shared with the logs table
+        ttl_seconds (float, optional): lifetime of an entry. Defaults to CACHE_TTL_SECONDS.
+        max_memory_entries (int, optional): size of the in-process LRU. Defaults to CACHE_MEMORY_ENTRIES.
+        max_disk_entries (int, optional): size of the on-disk table. Defaults to CACHE_DISK_ENTRIES.
+        enabled (bool, optional): when False every lookup is a miss and nothing is stored. Defaults to CACHE_ENABLED.
+    """
+
+    PRUNE_EVERY = 1000
+    TOUCH_BATCH = 256
+
+    def __init__(self, db_path:str, ttl_seconds:float=CACHE_TTL_SECONDS, max_memory_entries:int=CACHE_MEMORY_ENTRIES,
+                 max_disk_entries:int=CACHE_DISK_ENTRIES, enabled:bool=CACHE_ENABLED):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.enabled = enabled
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._con = None
+        self._sets_since_prune = 0
+        self._touched = {}
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._con is None:
+            self._con = sqlite3.connect(self.db_path, check_same_thread=False)
+            tune_connection(self._con)
+            self._con.execute("""
+                CREATE TABLE IF NOT EXISTS cache(
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    created_at REAL,
+                    accessed_at REAL
+                )
+            """)
+            self._con.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache(accessed_at)")
+            self._con.commit()
+        return self._con
+
+    def get(self, key:str) -> Optional[str]:
+        """Return the cached value for `key`, or None on a miss or expired entry."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                CACHE_LOOKUPS.inc(namespace=key.split(":", 1)[0], result="memory_hit")
+                return entry[0]
+            self._memory.pop(key, None)
+
+            con = self._connection()
+            row = con.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] >= self.ttl_seconds:
+                self.counters["misses"] += 1
+                CACHE_LOOKUPS.inc(namespace=key.split(":", 1)[0], result="miss")
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._save_access_times(con)
+                con.commit()
+            self._remember(key, row[0], row[1])
+            self.counters["disk_hits"] += 1
+            CACHE_LOOKUPS.inc(namespace=key.split(":", 1)[0], result="disk_hit")
+            return row[0]
+
+    def set(self, key:str, value:str):
+        """Store `value` under `key` in both tiers."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            con = self._connection()
+            self._touched.pop(key, None)
+            con.execute("INSERT OR REPLACE INTO cache(key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                        (key, value, now, now))
+            self._save_access_times(con)
+            con.commit()
+            self.counters["sets"] += 1
+            self._sets_since_prune += 1
+            if self._sets_since_prune >= self.PRUNE_EVERY:
+                self._prune(now)
+
+    def _remember(self, key:str, value:str, created_at:float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _save_access_times(self, con:sqlite3.Connection):
+        if self._touched:
+            con.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?",
+                            [(accessed_at, key) for key, accessed_at in self._touched.items()])
+            self._touched.clear()
+
+    def _prune(self, now:float):
+        con = self._connection()
+        cur = con.execute("DELETE FROM cache WHERE created_at <= ?", (now - self.ttl_seconds,))
+        evicted = cur.rowcount
+        cur = con.execute("""
+            DELETE FROM cache WHERE key IN (
+                SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_disk_entries,))
+        evicted += cur.rowcount
+        con.commit()
+        self.counters["evictions"] += evicted
+        self._sets_since_prune = 0
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current size of the memory tier."""
+        with self._lock:
+            stats = dict(self.counters, memory_entries=len(self._memory))
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
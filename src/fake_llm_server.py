@@ -0,0 +1,149 @@
+"""
+Stub LLM server for benchmarks and offline runs.
+
+Serves Ollama's `/api/generate` (streaming and non-streaming) and OpenAI's
+`/v1/chat/completions` on one port, answering every prompt with canned scores after a
+configurable latency. With `prompt_token_ms`, Ollama requests also pay for evaluating their
+prompt, except for the prefix shared with the previous request, which is reused like
+Ollama's prompt cache. Start it standalone with:
+    python fake_llm_server.py --port 11435 --first-token-ms 80 --token-ms 15
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_RESPONSE = '{"sentiment_score": 3, "offensive_score": 1}'
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set on the subclass created by `start_fake_llm_server`
+    first_token_ms = 50.0
+    token_ms = 10.0
+    prompt_token_ms = 0.0
+    response = CANNED_RESPONSE
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            # The client closed a keep-alive connection, e.g. to cancel a stream
+            pass
+
+    def _chunks(self) -> list[str]:
+        # Roughly one chunk per JSON token, like a streaming model
+        return [part + " " for part in self.response.split(" ")]
+
+    def _send(self, status:int, body:bytes, content_type:str="application/json", headers:dict=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send(200, json.dumps({"models": [{"name": "fake"}]}).encode())
+        else:
+            self._send(404, b"{}")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/generate":
+            self._ollama_generate(body)
+        elif self.path.endswith("/chat/completions"):
+            self._openai_chat(body)
+        else:
+            self._send(404, b"{}")
+
+    def _prompt_eval_seconds(self, body:dict) -> float:
+        # One slot: only the part after the prefix shared with the previous prompt is evaluated
+        prompt = body.get("system", "") + "\n" + body.get("prompt", "")
+        with self.server.prompt_lock:
+            previous, self.server.last_prompt = self.server.last_prompt, prompt
+        shared = len(os.path.commonprefix([previous, prompt]))
+        return (len(prompt) - shared) / 4 * self.prompt_token_ms / 1000
+
+    def _ollama_generate(self, body:dict):
+        chunks = self._chunks()
+        time.sleep(self.first_token_ms / 1000 + self._prompt_eval_seconds(body))
+        if not body.get("stream", True):
+            time.sleep(self.token_ms * (len(chunks) - 1) / 1000)
+            self._send(200, json.dumps({"model": body.get("model"), "response": self.response, "done": True}).encode())
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        lines = [{"model": body.get("model"), "response": chunk, "done": False} for chunk in chunks]
+        lines.append({"model": body.get("model"), "response": "", "done": True, "prompt_eval_count": len(body.get("prompt", "")) // 4})
+        try:
+            for i, line in enumerate(lines):
+                if i:
+                    time.sleep(self.token_ms / 1000)
+                data = (json.dumps(line) + "\n").encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            self.close_connection = True
+
+    def _openai_chat(self, body:dict):
+        time.sleep((self.first_token_ms + self.token_ms * (len(self._chunks()) - 1)) / 1000)
+        prompt_tokens = sum(len(message.get("content", "")) for message in body.get("messages", [])) // 4
+        completion = {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.response}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 15, "total_tokens": prompt_tokens + 15},
+        }
+        headers = {"x-ratelimit-remaining-requests": "10000", "x-ratelimit-remaining-tokens": "10000000"}
+        self._send(200, json.dumps(completion).encode(), headers=headers)
+
+def start_fake_llm_server(port:int=0, first_token_ms:float=50, token_ms:float=10, response:str=CANNED_RESPONSE,
+                          prompt_token_ms:float=0) -> ThreadingHTTPServer:
+    """
+    Start the stub server in a daemon thread.
+
+    Args:
+        port (int, optional): port to listen on, 0 picks a free one. Defaults to 0.
+        first_token_ms (float, optional): latency before the first token. Defaults to 50.
+        token_ms (float, optional): latency of every following token. Defaults to 10.
+        response (str, optional): text returned for every prompt. Defaults to CANNED_RESPONSE.
+        prompt_token_ms (float, optional): latency per prompt token not shared with the previous Ollama prompt. Defaults to 0.
+
+    Returns:
+        server (ThreadingHTTPServer): running server, its URL is http://127.0.0.1:{server.server_port}
+    """
+    handler = type("ConfiguredFakeLLMHandler", (FakeLLMHandler,),
+                   {"first_token_ms": first_token_ms, "token_ms": token_ms, "response": response,
+                    "prompt_token_ms": prompt_token_ms})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.last_prompt = ""
+    server.prompt_lock = threading.Lock()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-llm-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve canned Ollama and OpenAI responses.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--token-ms", type=float, default=10)
+    parser.add_argument("--prompt-token-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    server = start_fake_llm_server(args.port, args.first_token_ms, args.token_ms, prompt_token_ms=args.prompt_token_ms)
+    print(f"Fake LLM server on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,305 @@
+"""
+Fast first tier in front of the translate + LLM path.
+
+A character n-gram naive Bayes model, trained on the scores already stored in `logs.db`,
+scores the raw Turkish comment in well under a millisecond. When it is confident about both
+scores it answers directly; everything else goes on to the LLM. A small share of confident
+comments is still sent to the LLM (`FAST_CLASSIFIER_AUDIT_RATE`) to keep measuring how often
+the two agree.
+
+Train and calibrate from the logs, then enable it with FAST_CLASSIFIER_ENABLED=1:
+    python fast_classifier.py --db ../logs.db --output ../fast_classifier.json --min-agreement 0.9
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from cache import normalize_text
+from metrics import Gauge
+from near_duplicates import NEAR_DUP_MODEL_NAME
+
+FAST_CLASSIFIER_ENABLED = os.environ.get("FAST_CLASSIFIER_ENABLED", "0") == "1"
+FAST_CLASSIFIER_PATH = os.environ.get("FAST_CLASSIFIER_PATH", "../fast_classifier.json")
+# Overrides the threshold calibrated at training time when set
+FAST_CLASSIFIER_THRESHOLD = os.environ.get("FAST_CLASSIFIER_THRESHOLD")
+FAST_CLASSIFIER_AUDIT_RATE = float(os.environ.get("FAST_CLASSIFIER_AUDIT_RATE", 0.02))
+
+# Model name the fast tier's answers are logged under, excluded from its own training data
+FAST_MODEL_NAME = "fast-nb"
+TARGETS = ("sentiment_score", "offensive_score")
+CLASSES = (1, 2, 3, 4, 5)
+
+def char_ngrams(text:str, n_min:int=2, n_max:int=4) -> set[str]:
+    """Distinct character n-grams of the normalized text, padded so word boundaries count."""
+    padded = f" {normalize_text(text)} "
+    return {padded[i:i + n] for n in range(n_min, n_max + 1) for i in range(len(padded) - n + 1)}
+
+class NaiveBayesScorer:
+    """
+    Multinomial naive Bayes over the set of distinct character n-grams of a comment, predicting
+    one 1-5 score. Counting each n-gram once per comment keeps long comments from dominating.
+
+    Args:
+        alpha (float, optional): additive smoothing. Defaults to 1.0.
+        min_count (int, optional): drop n-grams seen in fewer comments. Defaults to 2.
+        max_features (int, optional): keep only the most frequent n-grams. Defaults to 200_000.
+    """
+
+    def __init__(self, alpha:float=1.0, min_count:int=2, max_features:int=200_000):
+        self.alpha = alpha
+        self.min_count = min_count
+        self.max_features = max_features
+        self.log_prior = {}
+        self.log_likelihood = {}
+
+    def fit(self, features:list[set[str]], labels:list[int]):
+        """Estimate the model from the n-gram sets of labelled comments."""
+        document_counts = Counter(ngram for ngrams in features for ngram in ngrams)
+        vocabulary = [ngram for ngram, count in document_counts.most_common(self.max_features) if count >= self.min_count]
+        index = {ngram: i for i, ngram in enumerate(vocabulary)}
+
+        class_counts = Counter(labels)
+        counts = {c: [0] * len(vocabulary) for c in CLASSES}
+        totals = dict.fromkeys(CLASSES, 0)
+        for ngrams, label in zip(features, labels):
+            row = counts[label]
+            for ngram in ngrams:
+                i = index.get(ngram)
+                if i is not None:
+                    row[i] += 1
+                    totals[label] += 1
+
+        n = len(labels)
+        self.log_prior = {c: math.log((class_counts[c] + self.alpha) / (n + self.alpha * len(CLASSES))) for c in CLASSES}
+        denominators = {c: math.log(totals[c] + self.alpha * len(vocabulary)) for c in CLASSES}
+        self.log_likelihood = {
+            ngram: [math.log(counts[c][i] + self.alpha) - denominators[c] for c in CLASSES]
+            for ngram, i in index.items()
+        }
+        return self
+
+    def predict_proba(self, ngrams:set[str]) -> list[float]:
+        """Posterior probability of each class in CLASSES."""
+        scores = [self.log_prior[c] for c in CLASSES]
+        for ngram in ngrams:
+            likelihood = self.log_likelihood.get(ngram)
+            if likelihood is not None:
+                scores = [s + l for s, l in zip(scores, likelihood)]
+        top = max(scores)
+        exp = [math.exp(s - top) for s in scores]
+        total = sum(exp)
+        return [e / total for e in exp]
+
+    def to_dict(self) -> dict:
+        return {"log_prior": {str(c): p for c, p in self.log_prior.items()}, "log_likelihood": self.log_likelihood}
+
+    @classmethod
+    def from_dict(cls, data:dict) -> "NaiveBayesScorer":
+        scorer = cls()
+        scorer.log_prior = {int(c): p for c, p in data["log_prior"].items()}
+        scorer.log_likelihood = data["log_likelihood"]
+        return scorer
+
+@dataclass
+class FastPrediction:
+    scores: dict
+    confidence: float
+    # Confident, but also sent to the LLM to measure agreement
+    audit: bool = False
+
+class FastClassifier:
+    """
+    Scores both targets and decides whether the answer is confident enough to skip the LLM.
+
+    Args:
+        scorers (dict[str, NaiveBayesScorer]): one scorer per name in TARGETS
+        threshold (float): lowest confidence, the smaller of the two class probabilities, answered directly
+        audit_rate (float, optional): share of confident comments also sent to the LLM. Defaults to FAST_CLASSIFIER_AUDIT_RATE.
+    """
+
+    def __init__(self, scorers:dict, threshold:float, audit_rate:float=FAST_CLASSIFIER_AUDIT_RATE):
+        self.scorers = scorers
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self._lock = threading.Lock()
+        self.counters = {"fast": 0, "llm": 0, "audited": 0, "agreed": 0}
+
+    def predict(self, text:str) -> tuple[dict, float]:
+        """Return the most likely scores and the confidence in both of them."""
+        ngrams = char_ngrams(text)
+        scores, confidence = {}, 1.0
+        for target, scorer in self.scorers.items():
+            proba = scorer.predict_proba(ngrams)
+            best = max(range(len(CLASSES)), key=proba.__getitem__)
+            scores[target] = CLASSES[best]
+            confidence = min(confidence, proba[best])
+        return scores, confidence
+
+    def route(self, text:str) -> Optional[FastPrediction]:
+        """
+        Decide who scores `text`.
+
+        Returns:
+            prediction (FastPrediction | None): None when the LLM has to score the comment. A prediction
+                with `audit=True` should be answered by the LLM and passed to `record_agreement`.
+        """
+        scores, confidence = self.predict(text)
+        if confidence < self.threshold:
+            self._count("llm")
+            return None
+        if random.random() < self.audit_rate:
+            self._count("audited")
+            return FastPrediction(scores, confidence, audit=True)
+        self._count("fast")
+        return FastPrediction(scores, confidence)
+
+    def record_agreement(self, prediction:FastPrediction, llm_scores:dict):
+        """Compare an audited prediction with the LLM's scores."""
+        if all(prediction.scores[target] == llm_scores[target] for target in TARGETS):
+            self._count("agreed")
+
+    def _count(self, name:str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> dict:
+        """Return the routing counters, the share answered by the fast tier and the audited agreement."""
+        with self._lock:
+            stats = dict(self.counters)
+        routed = stats["fast"] + stats["llm"] + stats["audited"]
+        stats["fast_rate"] = stats["fast"] / routed if routed else 0.0
+        stats["agreement"] = stats["agreed"] / stats["audited"] if stats["audited"] else None
+        return stats
+
+    def save(self, path:str):
+        data = {"threshold": self.threshold, "scorers": {target: s.to_dict() for target, s in self.scorers.items()}}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path:str) -> "FastClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        threshold = float(FAST_CLASSIFIER_THRESHOLD) if FAST_CLASSIFIER_THRESHOLD else data["threshold"]
+        return cls({target: NaiveBayesScorer.from_dict(s) for target, s in data["scorers"].items()}, threshold)
+
+def load_training_rows(db_path:str, model:Optional[str]=None) -> list[tuple]:
+    """Read (input, sentiment_score, offensive_score) rows scored by an LLM from the logs table."""
+    query = """
+        SELECT input, sentiment_score, offensive_score FROM logs
+        WHERE coalesce(model, '') != ? AND coalesce(model, '') NOT LIKE ? AND sentiment_score BETWEEN 1 AND 5 AND offensive_score BETWEEN 1 AND 5
+    """
+    params = [FAST_MODEL_NAME, f"{NEAR_DUP_MODEL_NAME}%"]
+    if model is not None:
+        query += " AND model = ?"
+        params.append(model)
+    con = sqlite3.connect(db_path)
+    try:
+        return con.execute(query, params).fetchall()
+    finally:
+        con.close()
+
+def calibrate_threshold(confidences:list[float], correct:list[bool], min_agreement:float) -> tuple[float, float]:
+    """
+    Pick the lowest threshold whose confident predictions still agree with the LLM at least
+    `min_agreement` of the time on held-out rows.
+
+    Returns:
+        threshold (float): calibrated threshold, above 1 when no threshold reaches the target
+        coverage (float): share of held-out rows the fast tier would answer
+    """
+    ranked = sorted(zip(confidences, correct), reverse=True)
+    threshold, covered, hits = 1.01, 0, 0
+    for i, (confidence, is_correct) in enumerate(ranked, start=1):
+        hits += is_correct
+        if hits / i >= min_agreement:
+            threshold, covered = confidence, i
+    return threshold, covered / len(ranked) if ranked else 0.0
+
+def train(rows:list[tuple], holdout:float=0.1, min_agreement:float=0.9, seed:int=0) -> tuple[FastClassifier, dict]:
+    """
+    Fit both scorers on logged rows and calibrate the threshold on a held-out share.
+
+    Args:
+        rows (list[tuple]): (input, sentiment_score, offensive_score) rows
+        holdout (float, optional): share of rows used for calibration. Defaults to 0.1.
+        min_agreement (float, optional): agreement with the LLM required of confident answers. Defaults to 0.9.
+        seed (int, optional): shuffle seed. Defaults to 0.
+
+    Returns:
+        classifier (FastClassifier): trained on all rows, with the calibrated threshold
+        report (dict): held-out size, accuracy, threshold and coverage
+    """
+    rows = list(rows)
+    random.Random(seed).shuffle(rows)
+    n_holdout = max(1, int(len(rows) * holdout))
+    train_rows, holdout_rows = rows[n_holdout:], rows[:n_holdout]
+
+    def fit(fit_rows):
+        features = [char_ngrams(text) for text, _, _ in fit_rows]
+        return {target: NaiveBayesScorer().fit(features, [row[i + 1] for row in fit_rows]) for i, target in enumerate(TARGETS)}
+
+    candidate = FastClassifier(fit(train_rows), threshold=0)
+    confidences, correct = [], []
+    for text, sentiment, offensive in holdout_rows:
+        scores, confidence = candidate.predict(text)
+        confidences.append(confidence)
+        correct.append(scores == {"sentiment_score": sentiment, "offensive_score": offensive})
+    threshold, coverage = calibrate_threshold(confidences, correct, min_agreement)
+
+    report = {"rows": len(rows), "holdout": len(holdout_rows), "accuracy": sum(correct) / len(correct),
+              "threshold": threshold, "coverage": coverage}
+    return FastClassifier(fit(rows), threshold), report
+
+_classifier = None
+_classifier_loaded = False
+_load_lock = threading.Lock()
+
+def get_fast_classifier() -> Optional[FastClassifier]:
+    """Load the trained classifier once. None when disabled or not trained yet."""
+    global _classifier, _classifier_loaded
+    if not _classifier_loaded:
+        with _load_lock:
+            if not _classifier_loaded:
+                if FAST_CLASSIFIER_ENABLED and os.path.exists(FAST_CLASSIFIER_PATH):
+                    _classifier = FastClassifier.load(FAST_CLASSIFIER_PATH)
+                _classifier_loaded = True
+    return _classifier
+
+def _agreement() -> dict:
+    agreement = _classifier.stats()["agreement"] if _classifier else None
+    # No sample until a comment has been audited
+    return {} if agreement is None else {(): agreement}
+
+Gauge("fast_classifier_fast_rate", "Share of routed comments answered by the fast classifier.",
+      fn=lambda: _classifier.stats()["fast_rate"] if _classifier else 0)
+Gauge("fast_classifier_agreement", "Share of audited comments where the fast classifier agreed with the LLM.", fn=_agreement)
+
+if __name__ == "__main__":
+    from utils import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Train the fast classifier on the scores stored in the logs table.")
+    parser.add_argument("--db", default=DB_PATH, help="logs database. Defaults to DB_PATH")
+    parser.add_argument("--output", default=FAST_CLASSIFIER_PATH, help="model file. Defaults to FAST_CLASSIFIER_PATH")
+    parser.add_argument("--model", help="only learn from the scores of this LLM")
+    parser.add_argument("--holdout", type=float, default=0.1, help="share of rows used to calibrate. Defaults to 0.1")
+    parser.add_argument("--min-agreement", type=float, default=0.9,
+                        help="agreement with the LLM required of direct answers. Defaults to 0.9")
+    parser.add_argument("--min-rows", type=int, default=1000, help="refuse to train on fewer rows. Defaults to 1000")
+    args = parser.parse_args()
+
+    rows = load_training_rows(args.db, args.model)
+    if len(rows) < args.min_rows:
+        raise SystemExit(f"Only {len(rows)} scored rows in {args.db}, need at least {args.min_rows}")
+    classifier, report = train(rows, args.holdout, args.min_agreement)
+    classifier.save(args.output)
+    print(json.dumps(report, indent=2))
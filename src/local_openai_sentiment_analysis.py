@@ -1,17 +1,38 @@
 
 import json
 import logging
+import random
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
+from typing import Iterator, Optional
 
-import gradio as gr
+from analytics import ensure_analytics
+from archive import ARCHIVE_ENABLED, start_compaction
+from cache import ResultCache, cache_key
+from fast_classifier import FAST_MODEL_NAME, get_fast_classifier
+from log_writer import LogWriter, tune_connection
+from metrics import METRICS_PORT, PARSE_FAILURES, REQUESTS, log_payload, span, start_metrics_server
+from near_duplicates import get_near_duplicate_index, near_duplicate_model_name
+from openai_client import get_scheduled_openai_completion
+from priority import INTERACTIVE, default_deadline, stage_slot
+from router import local_router
+from score_stream import ScoreExtractor
+from structured_output import parse_scores
+from translators import TRANSLATORS, translator_id
 from utils import (
+    DB_PATH,
     LOCAL_MODEL,
     OPENAI_MODEL,
+    PIPELINE_MODE,
+    SHADOW_SAMPLE_RATE,
+    TRANSLATOR,
     get_local_completion,
-    get_openai_completion,
     gr_descr_html,
-    nllb_translate_tr_to_eng,
+    stream_local_completion,
+    translate_tr_to_eng,
+    warm_up,
 )
 
 # Set up logging
@@ -22,9 +43,16 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def initialize_db():
-    """Initialize the database and create the logs table if it doesn't exist."""
-    con = sqlite3.connect("../logs.db", check_same_thread=False)
+# Bump whenever the prompt changes so cached completions of the old prompt are not reused
+PROMPT_VERSION = "2"
+result_cache = ResultCache(DB_PATH)
+# Most shadow comparisons running at once, further samples are skipped
+SHADOW_MAX_IN_FLIGHT = 2
+
+def initialize_db(db_path:str=DB_PATH):
+    """Initialize the database and create the logs and shadow_runs tables, their indexes and the hourly rollup if they don't exist."""
+    con = sqlite3.connect(db_path, check_same_thread=False)
+    tune_connection(con)
     cur = con.cursor()
     cur.execute("""
                 CREATE TABLE IF NOT EXISTS logs(
@@ -37,47 +65,37 @@ def initialize_db():
                     timestamp DATE DEFAULT (datetime('now','localtime'))
                 )
             """)
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS shadow_runs(
+                    ID INTEGER PRIMARY KEY,
+                    input TEXT,
+                    model TEXT,
+                    translator TEXT,
+                    translation_ms REAL,
+                    translate_completion_ms REAL,
+                    direct_completion_ms REAL,
+                    translate_sentiment_score INT,
+                    translate_offensive_score INT,
+                    direct_sentiment_score INT,
+                    direct_offensive_score INT,
+                    timestamp DATE DEFAULT (datetime('now','localtime'))
+                )
+            """)
+    cur.execute("CREATE INDEX IF NOT EXISTS shadow_runs_timestamp ON shadow_runs(timestamp)")
+    ensure_analytics(con)
     con.close()
 
 @contextmanager
 def get_db_connection():
     """Context manager for handling the database connection."""
-    con = sqlite3.connect("../logs.db", check_same_thread=False)
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
     try:
         yield con
     finally:
         con.close()
 
-def sentiment_analyzer(input:str, is_local:bool)->int:
-    """
-    Generate sentiment and offensive lang analyze
-
-    Args:
-        input (str): social media comment in turkish
-
-    Returns:
-        response['sentiment_score'] (int): sentiment score: 1, 2, 3, 4, 5
-        response['offensive_score'] (int): offensive lang score: 1, 2, 3, 4, 5
-    """
-
-    logger.info(f"Original Input: {input}")
-    if is_local:
-        input_eng = nllb_translate_tr_to_eng(article=input)
-        logger.info(f"Translated Input: {input_eng}")
-        comment = input_eng
-        MODEL = LOCAL_MODEL
-        get_completion = get_local_completion
-    else:
-        input_eng = None
-        comment = input
-        MODEL = OPENAI_MODEL
-        get_completion = get_openai_completion
-    logger.info(f"Model: {MODEL}")
-    
-    prompt = f"""
-    Your task is to perform the following actions based on a social media comment, delimited by <>:
-    
-    1 - Assign a sentiment score from 1 to 5 for the comment, where: \
+# Score definitions, shared with the packed prompts of packing.py
+SCORING_SCALES = """    1 - Assign a sentiment score from 1 to 5 for the comment, where: \
         1 = Very Negative
         2 = Negative
         3 = Neutral
@@ -88,42 +106,331 @@ def sentiment_analyzer(input:str, is_local:bool)->int:
         2 = Slightly Offensive
         3 = Moderately Offensive
         4 = Offensive
-        5 = Highly Offensive
+        5 = Highly Offensive"""
+
+# Fixed scoring instructions. Sent as the system prompt, ahead of the comment and identical on
+# every call, so Ollama reuses the evaluated prefix and OpenAI can cache it
+SYSTEM_PROMPT = f"""
+    Your task is to perform the following actions based on a social media comment, delimited by <>:
+    
+{SCORING_SCALES}
     
     Format your response as a JSON object with the keys \
     'sentiment_score' and 'offensive_score'. 
     Make your response as short as possible without any additional explanation.
+"""
 
-    Comment: <{comment}>
+def build_comment_prompt(comment:str) -> str:
     """
+    Build the per-comment part of the scoring prompt, sent after SYSTEM_PROMPT.
 
-    response = get_completion(prompt)
-    logger.info(f"Raw Response: {response}")
+    Args:
+        comment (str): social media comment, english for the local model and turkish for OpenAI
 
-    with get_db_connection() as con:
-        cur = con.cursor()
-        try:
-            # Remove backslashes from response and turn from str to dict
-            res_dict = json.loads(response.replace('\\', ''))
+    Returns:
+        prompt (str): the comment delimited by <>
+    """
+    return f"Comment: <{comment}>"
+
+def build_prompt(comment:str) -> str:
+    """
+    Build the scoring prompt for a single comment as one message, for callers that cannot send
+    a system prompt.
+
+    Args:
+        comment (str): social media comment, english for the local model and turkish for OpenAI
+
+    Returns:
+        prompt (str): prompt asking for 'sentiment_score' and 'offensive_score' as JSON
+    """
+    prompt = f"""{SYSTEM_PROMPT}
+    {build_comment_prompt(comment)}
+    """
+    return prompt
+
+def parse_response(response:str) -> dict:
+    """
+    Turn a raw model response into a dict with 'sentiment_score' and 'offensive_score'.
+
+    Args:
+        response (str): raw response from the local or OpenAI model
+
+    Returns:
+        res_dict (dict): parsed response
+    """
+    # Remove backslashes from response and turn from str to dict
+    res_dict = json.loads(response.replace('\\', ''))
+    return res_dict
+
+def insert_logs(con:sqlite3.Connection, rows:list[tuple]):
+    """
+    Write scored comments into the logs table in a single transaction.
+
+    Args:
+        con (sqlite3.Connection): open database connection
+        rows (list[tuple]): (input, model, eng_input, sentiment_score, offensive_score) tuples
+    """
+    cur = con.cursor()
+    cur.executemany("""
+        INSERT INTO logs(ID, input, model, eng_input, sentiment_score, offensive_score) VALUES
+            (NULL, ?, ?, ?, ?, ?)
+    """, rows)
+    con.commit()
+
+def insert_shadow_runs(con:sqlite3.Connection, rows:list[tuple]):
+    """
+    Write shadow comparisons of the translate and direct pipelines in a single transaction.
+
+    Args:
+        con (sqlite3.Connection): open database connection
+        rows (list[tuple]): tuples in the column order of the shadow_runs table, without ID and timestamp
+    """
+    cur = con.cursor()
+    cur.executemany("""
+        INSERT INTO shadow_runs(input, model, translator, translation_ms, translate_completion_ms, direct_completion_ms,
+                                translate_sentiment_score, translate_offensive_score,
+                                direct_sentiment_score, direct_offensive_score)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    con.commit()
+
+# Rows are written by a background thread in group commits
+log_writer = LogWriter(DB_PATH, insert_logs)
+shadow_writer = LogWriter(DB_PATH, insert_shadow_runs, name="shadow_runs")
+_shadow_slots = threading.BoundedSemaphore(SHADOW_MAX_IN_FLIGHT)
+
+def translate_cached(article:str, translator:str=TRANSLATOR, priority:str=INTERACTIVE, deadline:Optional[float]=None) -> str:
+    """Translate unless the (normalized) article has been translated by the same translator before."""
+    key = cache_key("translation", article, translator_id(translator))
+    eng = result_cache.get(key)
+    if eng is None:
+        with stage_slot("translation", priority, deadline):
+            eng = translate_tr_to_eng(article, translator=translator)
+        result_cache.set(key, eng)
+    return eng
+
+def peek_cached_completion(input:str, is_local:bool, translator:str, model:str) -> tuple:
+    """
+    Look up the cached completion of a comment without translating it.
+
+    Returns:
+        key (str | None): completion cache key, None when the comment needs a translation that is not cached
+        response (str | None): cached completion, None on a miss
+    """
+    comment = input
+    if is_local and PIPELINE_MODE != "direct":
+        comment = result_cache.get(cache_key("translation", input, translator_id(translator)))
+        if comment is None:
+            return None, None
+    key = cache_key("completion", comment, model, PROMPT_VERSION)
+    return key, result_cache.get(key)
+
+def compare_pipelines(input:str, translator:str=TRANSLATOR) -> tuple:
+    """
+    Score a comment with the local model both through the translator and directly in turkish,
+    bypassing the caches so every stage is timed.
+
+    Args:
+        input (str): social media comment in turkish
+        translator (str, optional): translator of the translate pipeline. Defaults to the TRANSLATOR env var.
+
+    Returns:
+        row (tuple): row for `insert_shadow_runs`
+    """
+    start = time.perf_counter()
+    input_eng = translate_tr_to_eng(input, translator=translator)
+    translated_at = time.perf_counter()
+    translated = parse_scores(get_local_completion(build_comment_prompt(input_eng), stop_when_scored=True, structured=True,
+                                                   system=SYSTEM_PROMPT))
+    translate_done_at = time.perf_counter()
+    direct = parse_scores(get_local_completion(build_comment_prompt(input), stop_when_scored=True, structured=True,
+                                               system=SYSTEM_PROMPT))
+    direct_done_at = time.perf_counter()
+    return (input, LOCAL_MODEL, translator,
+            (translated_at - start) * 1000, (translate_done_at - translated_at) * 1000, (direct_done_at - translate_done_at) * 1000,
+            translated["sentiment_score"], translated["offensive_score"], direct["sentiment_score"], direct["offensive_score"])
 
-            # WRITE INTO DB
-            cur.execute("""
-                INSERT INTO logs(ID, input, model, eng_input, sentiment_score, offensive_score) VALUES
-                    (NULL, ?, ?, ?, ?, ?)
-            """, (input, MODEL, input_eng, res_dict['sentiment_score'], res_dict['offensive_score']))
-            con.commit()
+def start_shadow_comparison(input:str, translator:str=TRANSLATOR) -> bool:
+    """
+    Run `compare_pipelines` in the background and log its result to shadow_runs.
 
-            return res_dict['sentiment_score'], res_dict['offensive_score']
+    Returns:
+        started (bool): False when SHADOW_MAX_IN_FLIGHT comparisons are already running
+    """
+    if not _shadow_slots.acquire(blocking=False):
+        return False
 
+    def run():
+        try:
+            shadow_writer.submit(compare_pipelines(input, translator))
         except Exception as e:
-            logger.error(e)
-            raise Exception("Error processing sentiment analysis")
+            logger.error(f"Shadow comparison failed: {e}")
+        finally:
+            _shadow_slots.release()
+
+    threading.Thread(target=run, name="shadow-comparison", daemon=True).start()
+    return True
+
+def sentiment_analyzer_stream(input:str, is_local:bool, translator:str=TRANSLATOR, priority:str=INTERACTIVE,
+                              deadline:Optional[float]=None) -> Iterator[tuple]:
+    """
+    Generate sentiment and offensive lang analyze, yielding each score as soon as it is known.
+    The local model's generation is cancelled once both scores have been streamed. Local calls
+    are balanced over OLLAMA_URLS and may overflow to OpenAI, see router.py. When the fast
+    classifier is enabled and confident, or the comment is a near duplicate of one scored
+    before, it answers without translation or LLM call. The local path translates first unless
+    PIPELINE_MODE is 'direct'. Translation and completion wait for a slot of their stage by
+    priority class, see priority.py.
+
+    Args:
+        input (str): social media comment in turkish
+        is_local (bool): translate and score with the local Ollama model instead of OpenAI
+        translator (str, optional): translator used by the local model, one of translators.TRANSLATORS. Defaults to the TRANSLATOR env var.
+        priority (str, optional): "interactive" for live requests, "bulk" for backfills. Defaults to "interactive".
+        deadline (float, optional): `time.monotonic()` time after which waiting work is shed. Defaults to the priority's default deadline.
+
+    Yields:
+        scores (tuple): (sentiment_score, offensive_score), None for a score that has not arrived yet.
+            The last tuple holds both scores.
+    """
+
+    log_payload(f"Original Input: {input}")
+    if deadline is None:
+        deadline = default_deadline(priority)
+    near_duplicates = get_near_duplicate_index(DB_PATH)
+    requested_model = LOCAL_MODEL if is_local else OPENAI_MODEL
+    checked_key = checked_response = None
+    if near_duplicates is not None:
+        # Exact repeats are answered from the result cache below, never as near duplicates
+        with span("cache_lookup"):
+            checked_key, checked_response = peek_cached_completion(input, is_local, translator, requested_model)
+    if near_duplicates is not None and checked_response is None:
+        with span("near_duplicate"):
+            match = near_duplicates.lookup(input, requested_model)
+        if match is not None:
+            log_payload(f"Near duplicate: {match.scores} (similarity: {match.similarity:.2f})")
+            REQUESTS.inc(model=match.model, route="near_duplicate")
+            log_writer.submit((input, near_duplicate_model_name(match.model), None, match.scores['sentiment_score'], match.scores['offensive_score']))
+            yield match.scores['sentiment_score'], match.scores['offensive_score']
+            return
+
+    fast_classifier = get_fast_classifier()
+    fast = None
+    if fast_classifier is not None:
+        with span("fast_classifier"):
+            fast = fast_classifier.route(input)
+    if fast is not None and not fast.audit:
+        log_payload(f"Fast classifier: {fast.scores} (confidence: {fast.confidence:.3f})")
+        REQUESTS.inc(model=FAST_MODEL_NAME, route="fast")
+        log_writer.submit((input, FAST_MODEL_NAME, None, fast.scores['sentiment_score'], fast.scores['offensive_score']))
+        yield fast.scores['sentiment_score'], fast.scores['offensive_score']
+        return
+
+    if is_local and PIPELINE_MODE == "direct":
+        input_eng = None
+        comment = input
+        MODEL = LOCAL_MODEL
+    elif is_local:
+        if PIPELINE_MODE == "shadow" and random.random() < SHADOW_SAMPLE_RATE:
+            start_shadow_comparison(input, translator)
+        with span("translation", translator=translator):
+            input_eng = translate_cached(input, translator, priority, deadline)
+        log_payload(f"Translated Input ({translator}): {input_eng}")
+        comment = input_eng
+        MODEL = LOCAL_MODEL
+    else:
+        input_eng = None
+        comment = input
+        MODEL = OPENAI_MODEL
+
+    key = cache_key("completion", comment, MODEL, PROMPT_VERSION)
+    if key == checked_key:
+        response = checked_response
+    else:
+        with span("cache_lookup"):
+            response = result_cache.get(key)
+    is_cached = response is not None
+    if not is_cached:
+        prompt = build_comment_prompt(comment)
+        with span("completion", model=MODEL), stage_slot("completion", priority, deadline):
+            if is_local:
+                with local_router.route() as backend:
+                    if backend is None:
+                        # Every Ollama host is down or slower than the SLO, spill over to OpenAI
+                        MODEL = OPENAI_MODEL
+                        key = cache_key("completion", comment, MODEL, PROMPT_VERSION)
+                        response = get_scheduled_openai_completion(prompt, system=SYSTEM_PROMPT)
+                    else:
+                        extractor = ScoreExtractor()
+                        for extractor in stream_local_completion(prompt, url=f"{backend.url}/api/generate",
+                                                                 stop_when_scored=True, structured=True,
+                                                                 system=SYSTEM_PROMPT):
+                            yield extractor.scores.get("sentiment_score"), extractor.scores.get("offensive_score")
+                        response = extractor.to_response()
+            else:
+                response = get_scheduled_openai_completion(prompt, system=SYSTEM_PROMPT)
+    log_payload(f"Raw Response: {response} (cached: {is_cached})")
+
+    try:
+        with span("parse"):
+            res_dict = parse_scores(response)
+        if not is_cached:
+            # Store the validated scores so a repaired response is not repaired again
+            result_cache.set(key, json.dumps(res_dict))
+        if fast is not None:
+            fast_classifier.record_agreement(fast, res_dict)
+        if near_duplicates is not None:
+            near_duplicates.add(input, MODEL, res_dict)
+
+        # WRITE INTO DB, off the request path
+        log_writer.submit((input, MODEL, input_eng, res_dict['sentiment_score'], res_dict['offensive_score']))
+        REQUESTS.inc(model=MODEL, route="cached" if is_cached else "llm")
+
+    except Exception as e:
+        PARSE_FAILURES.inc(model=MODEL)
+        logger.error(e)
+        raise Exception("Error processing sentiment analysis")
+
+    yield res_dict['sentiment_score'], res_dict['offensive_score']
+
+def sentiment_analyzer(input:str, is_local:bool, translator:str=TRANSLATOR, priority:str=INTERACTIVE,
+                       deadline:Optional[float]=None)->int:
+    """
+    Generate sentiment and offensive lang analyze
+
+    Args:
+        input (str): social media comment in turkish
+        is_local (bool): translate and score with the local Ollama model instead of OpenAI
+        translator (str, optional): translator used by the local model, one of translators.TRANSLATORS. Defaults to the TRANSLATOR env var.
+        priority (str, optional): "interactive" for live requests, "bulk" for backfills. Defaults to "interactive".
+        deadline (float, optional): `time.monotonic()` time after which waiting work is shed. Defaults to the priority's default deadline.
+
+    Returns:
+        response['sentiment_score'] (int): sentiment score: 1, 2, 3, 4, 5
+        response['offensive_score'] (int): offensive lang score: 1, 2, 3, 4, 5
+    """
+    with span("end_to_end", local=is_local, priority=priority):
+        for scores in sentiment_analyzer_stream(input, is_local, translator, priority, deadline):
+            pass
+    return scores
 
 if __name__ == "__main__":
+    # Imported here so batch tools that reuse this module do not pay for gradio
+    import gradio as gr
+
     initialize_db()
+    # Start rebuilding the near-duplicate index while the translator loads
+    get_near_duplicate_index(DB_PATH)
+    if ARCHIVE_ENABLED:
+        start_compaction(DB_PATH)
+    warm_up()
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
     
-    demo = gr.Interface(fn=sentiment_analyzer,
-                        inputs=[gr.Textbox(label="Social Media Comment", lines=1.8), gr.Checkbox(label="Local LLM")], 
+    # Scores show up in the UI as soon as the model streams them
+    demo = gr.Interface(fn=sentiment_analyzer_stream,
+                        inputs=[gr.Textbox(label="Social Media Comment", lines=1.8), gr.Checkbox(label="Local LLM"),
+                                gr.Dropdown(choices=sorted(TRANSLATORS), value=TRANSLATOR, label="Translator (Local LLM)")],
                         outputs=[gr.Textbox(label="Sentiment Score"), gr.Textbox(label="Offensive Language Score")],
                         title="Social Media Analysis",
                         description=gr_descr_html,
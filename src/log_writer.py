@@ -0,0 +1,176 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+from metrics import Counter, Gauge, Histogram
+
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10_000))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 256))
+LOG_FLUSH_MS = float(os.environ.get("LOG_FLUSH_MS", 200))
+LOG_BLOCK_MS = float(os.environ.get("LOG_BLOCK_MS", 50))
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_writers = []
+
+DB_WRITE_SECONDS = Histogram("db_write_seconds", "Time to write and commit one group of log rows.", ("writer",))
+LOG_ROWS = Counter("log_writer_rows_total", "Log rows by what happened to them.", ("writer", "outcome"))
+QUEUE_DEPTH = Gauge("log_writer_queue_depth", "Log rows waiting to be written.", ("writer",),
+                    fn=lambda: {(writer.name,): writer._queue.qsize() for writer in list(_writers)})
+
+def tune_connection(con:sqlite3.Connection):
+    """Switch a connection to WAL with pragmas suited to many small appends."""
+    # Lets archive.compact return the pages of deleted rows to the file system. Only takes effect
+    # on a new database, and has to come before the switch to WAL
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA busy_timeout=5000")
+
+class LogWriter:
+    """
+    Write log rows to SQLite from a single background thread, in group commits.
+
+    Request threads `submit` rows into a bounded queue and return immediately. The writer
+    commits once `batch_size` rows are pending or `flush_ms` after the first pending row,
+    whichever comes first. When the queue is full, `submit` waits up to `block_ms` and then
+    drops the row; both cases are counted.
+
+    Args:
+        db_path (str): SQLite database file
+        write_fn (Callable[[sqlite3.Connection, list], None]): writes and commits a list of rows
+        max_queue (int, optional): queue bound. Defaults to LOG_QUEUE_SIZE.
+        batch_size (int, optional): rows per group commit. Defaults to LOG_BATCH_SIZE.
+        flush_ms (float, optional): longest time a row waits before it is committed. Defaults to LOG_FLUSH_MS.
+        block_ms (float, optional): how long `submit` waits on a full queue. Defaults to LOG_BLOCK_MS.
+        name (str, optional): label of the writer's metrics. Defaults to "logs".
+    """
+
+    def __init__(self, db_path:str, write_fn:Callable[[sqlite3.Connection, list], None], max_queue:int=LOG_QUEUE_SIZE,
+                 batch_size:int=LOG_BATCH_SIZE, flush_ms:float=LOG_FLUSH_MS, block_ms:float=LOG_BLOCK_MS,
+                 name:str="logs"):
+        self.db_path = db_path
+        self.write_fn = write_fn
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.block_timeout = block_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self._counter_lock = threading.Lock()
+        self.counters = {"submitted": 0, "written": 0, "batches": 0, "blocked": 0, "dropped": 0, "failed": 0}
+        _writers.append(self)
+
+    def start(self):
+        """Start the writer thread. Called automatically by the first `submit`."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        return self
+
+    def submit(self, row:tuple) -> bool:
+        """
+        Queue a row for writing without waiting for the database.
+
+        Args:
+            row (tuple): row passed on to `write_fn`
+
+        Returns:
+            queued (bool): False when the row was dropped because the queue stayed full
+        """
+        if self._closed:
+            self._count("dropped")
+            return False
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._count("blocked")
+            try:
+                self._queue.put(row, timeout=self.block_timeout)
+            except queue.Full:
+                self._count("dropped")
+                logger.warning("Log queue full, dropped a row")
+                return False
+        self._count("submitted")
+        return True
+
+    def close(self, timeout:float=10):
+        """Stop accepting rows, write everything still queued and close the connection."""
+        with self._start_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        """Return the counters and the current queue depth."""
+        with self._counter_lock:
+            return dict(self.counters, queue_depth=self._queue.qsize())
+
+    def _count(self, name:str, n:int=1):
+        with self._counter_lock:
+            self.counters[name] += n
+        if name != "batches":
+            LOG_ROWS.inc(n, writer=self.name, outcome=name)
+
+    def _run(self):
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        tune_connection(con)
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(con, batch)
+
+        # Drain whatever was queued before close()
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            self._write(con, batch)
+        con.close()
+
+    def _write(self, con:sqlite3.Connection, batch:list):
+        try:
+            with DB_WRITE_SECONDS.time(writer=self.name):
+                self.write_fn(con, batch)
+            self._count("written", len(batch))
+            self._count("batches")
+        except Exception as e:
+            con.rollback()
+            self._count("failed", len(batch))
+            logger.error(f"Failed to write {len(batch)} log rows: {e}")
@@ -0,0 +1,295 @@
+"""
+Prometheus-style metrics and span tracing for the pipeline, without extra dependencies.
+
+Metrics are kept in process and rendered in the Prometheus text format by `render()`. The HTTP
+API serves them at `/metrics`; other processes, e.g. the Gradio app, can expose them with
+`start_metrics_server(port)`.
+
+`span(stage)` times a block of work into the `pipeline_stage_seconds` histogram. When tracing
+is enabled (TRACING_ENABLED=1, or any hook registered with `add_span_hook`), every span is also
+handed to the hooks with its trace id, parent span and attributes. TRACING_OTEL=1 forwards spans
+to OpenTelemetry, if it is installed.
+
+`log_payload` logs raw comments and responses for only LOG_PAYLOAD_SAMPLE_RATE of the calls.
+"""
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+METRICS_PORT = os.environ.get("METRICS_PORT")
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "0") == "1"
+TRACING_OTEL = os.environ.get("TRACING_OTEL", "0") == "1"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 0.01))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; from cache hits to slow CPU translations and LLM calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+_registry_lock = threading.Lock()
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames:tuple, values:tuple, extra:str="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value:float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name:str, documentation:str, labelnames:tuple=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _key(self, labels:dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self._samples())
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests per model."""
+
+    type = "counter"
+
+    def __init__(self, name:str, documentation:str, labelnames:tuple=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in sorted(values.items())]
+
+class Gauge(_Metric):
+    """
+    Current value, e.g. a queue depth. Either `set` it or pass `fn`, which is called at scrape
+    time and returns a number, or a dict from label value tuples to numbers.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name:str, documentation:str, labelnames:tuple=(), fn:Optional[Callable[[], object]]=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self._values = {}
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> list[str]:
+        if self.fn is not None:
+            try:
+                values = self.fn()
+            except Exception as e:
+                logger.warning(f"Gauge {self.name} failed: {e}")
+                return []
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in sorted(values.items())]
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, e.g. stage latencies in seconds."""
+
+    type = "histogram"
+
+    def __init__(self, name:str, documentation:str, labelnames:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_metrics)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+STAGE_SECONDS = Histogram("pipeline_stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+REQUESTS = Counter("pipeline_requests_total", "Scored comments by model and how they were answered.", ("model", "route"))
+PARSE_FAILURES = Counter("pipeline_parse_failures_total", "Responses whose scores could not be parsed.", ("model",))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_hooks = []
+
+def add_span_hook(hook:Callable[[dict], None]):
+    """
+    Call `hook(span)` for every finished span. A span is a dict with 'name', 'trace_id',
+    'span_id', 'parent_id', 'start' (epoch seconds), 'duration' (seconds), 'attributes' and 'error'.
+    """
+    _span_hooks.append(hook)
+
+@contextmanager
+def span(stage:str, **attributes):
+    """
+    Time a pipeline stage into `pipeline_stage_seconds` and, when tracing, report it as a span.
+    Spans opened inside the block become its children.
+
+    Args:
+        stage (str): stage name, e.g. "translation" or "completion"
+        **attributes: extra details passed on to the span hooks, e.g. model=...
+
+    Yields:
+        attributes (dict): add attributes while the stage runs, e.g. cached=True
+    """
+    tracing = TRACING_ENABLED or bool(_span_hooks)
+    parent = _current_span.get()
+    record = None
+    if tracing:
+        record = {
+            "name": stage, "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16], "parent_id": parent["span_id"] if parent else None,
+            "start": time.time(), "attributes": attributes, "error": None,
+        }
+        token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        if record is not None:
+            record["error"] = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if record is not None:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # A generator resumed in another context, e.g. by a streaming Gradio handler
+                _current_span.set(parent)
+            record["duration"] = duration
+            for hook in list(_span_hooks):
+                try:
+                    hook(record)
+                except Exception as e:
+                    logger.warning(f"Span hook failed: {e}")
+
+def log_span(record:dict):
+    """Span hook writing one log line per span."""
+    logger.info(f"span {record['name']} trace={record['trace_id']} id={record['span_id']} parent={record['parent_id']} "
+                 f"{record['duration'] * 1000:.1f}ms {record['attributes']} error={record['error']}")
+
+def otel_span_hook() -> Callable[[dict], None]:
+    """Build a span hook that re-emits spans through the OpenTelemetry API."""
+    from opentelemetry import trace
+    tracer = trace.get_tracer("sentiment_analysis")
+
+    def hook(record:dict):
+        start_ns = int(record["start"] * 1e9)
+        otel_span = tracer.start_span(record["name"], start_time=start_ns,
+                                      attributes={key: str(value) for key, value in record["attributes"].items()})
+        if record["error"]:
+            otel_span.set_attribute("error", record["error"])
+        otel_span.end(end_time=start_ns + int(record["duration"] * 1e9))
+
+    return hook
+
+if TRACING_ENABLED:
+    add_span_hook(log_span)
+if TRACING_OTEL:
+    try:
+        add_span_hook(otel_span_hook())
+    except ImportError:
+        logger.warning("TRACING_OTEL=1 but opentelemetry is not installed")
+
+def log_payload(message:str, rate:Optional[float]=None):
+    """Log a message carrying raw comments or responses for a sampled share of calls only."""
+    if random.random() < (LOG_PAYLOAD_SAMPLE_RATE if rate is None else rate):
+        logger.info(message)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port:int, host:str="0.0.0.0") -> ThreadingHTTPServer:
+    """Serve `/metrics` from a daemon thread, for processes without the HTTP API."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
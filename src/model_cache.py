@@ -0,0 +1,103 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+
+def model_size_bytes(obj) -> int:
+    """Estimate the memory held by a loaded translator from the parameters of its torch model."""
+    model = getattr(obj, "model", obj)
+    parameters = getattr(model, "parameters", None)
+    if parameters is None:
+        return 0
+    return sum(p.numel() * p.element_size() for p in parameters())
+
+class ModelCache:
+    """
+    Keep loaded models in memory, shared by all threads, within a count and size bound.
+
+    Each name is loaded once by `loader(name)`, even when many threads ask for it at the same
+    time. When the cache grows past `max_models` or `max_bytes`, the least recently used models
+    that no thread is currently using are dropped.
+
+    Args:
+        loader (Callable[[str], object]): loads the model for a name
+        max_models (int, optional): most models kept loaded. Defaults to 2.
+        max_bytes (int, optional): most estimated parameter bytes kept loaded. Defaults to 8 GiB.
+        size_fn (Callable[[object], int], optional): estimates the bytes of a loaded model. Defaults to model_size_bytes.
+    """
+
+    def __init__(self, loader:Callable[[str], object], max_models:int=2, max_bytes:int=8 * 1024 ** 3,
+                 size_fn:Callable[[object], int]=model_size_bytes):
+        self.loader = loader
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.counters = {"hits": 0, "loads": 0, "evictions": 0}
+
+    @contextmanager
+    def use(self, name:str):
+        """
+        Borrow the model for `name`, loading it if needed. It cannot be evicted while borrowed.
+
+        Args:
+            name (str): model name passed to the loader
+
+        Yields:
+            model: the loaded model
+        """
+        entry = self._acquire(name)
+        try:
+            yield entry["model"]
+        finally:
+            with self._lock:
+                entry["in_use"] -= 1
+                entry["last_used"] = time.monotonic()
+                self._evict()
+
+    def _acquire(self, name:str) -> dict:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry["in_use"] += 1
+                self.counters["hits"] += 1
+                return entry
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Load outside the cache lock so other models stay usable meanwhile
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry["in_use"] += 1
+                    self.counters["hits"] += 1
+                    return entry
+            model = self.loader(name)
+            entry = {"model": model, "bytes": self.size_fn(model), "in_use": 1, "last_used": time.monotonic()}
+            with self._lock:
+                self._entries[name] = entry
+                self.counters["loads"] += 1
+                self._evict()
+            return entry
+
+    def _evict(self):
+        idle = sorted((entry["last_used"], name) for name, entry in self._entries.items() if entry["in_use"] == 0)
+        evicted = False
+        for _, name in idle:
+            total_bytes = sum(entry["bytes"] for entry in self._entries.values())
+            if len(self._entries) <= self.max_models and total_bytes <= self.max_bytes:
+                break
+            del self._entries[name]
+            self.counters["evictions"] += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def loaded(self) -> list[str]:
+        """Return the names of the models currently in memory."""
+        with self._lock:
+            return list(self._entries)
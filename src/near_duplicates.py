@@ -0,0 +1,271 @@
+"""
+Reuse the scores of near-duplicate comments.
+
+Bot and campaign traffic repeats the same text with small changes: another username, an
+emoji, different punctuation. The exact-match cache misses those, so each variant would be
+translated and scored again. This index keeps a MinHash signature of every comment the LLM
+scored and finds earlier comments whose estimated Jaccard similarity is at least
+NEAR_DUP_THRESHOLD, using locality-sensitive hashing over bands of the signature.
+
+Signatures use one-permutation hashing: every shingle is hashed once into one of
+NUM_PERM bins and each bin keeps its minimum, so a signature costs one pass over the text.
+The index is rebuilt from the logs table in the background at startup, grows with every new
+LLM answer and keeps at most NEAR_DUP_MAX_ENTRIES comments, dropping the oldest first.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from cache import normalize_text
+from metrics import Counter, Gauge
+
+NEAR_DUP_ENABLED = os.environ.get("NEAR_DUP_ENABLED", "0") == "1"
+NEAR_DUP_THRESHOLD = float(os.environ.get("NEAR_DUP_THRESHOLD", 0.85))
+NEAR_DUP_MAX_ENTRIES = int(os.environ.get("NEAR_DUP_MAX_ENTRIES", 50_000))
+# Shorter comments differ in too few shingles to tell a variant from a different comment
+NEAR_DUP_MIN_CHARS = int(os.environ.get("NEAR_DUP_MIN_CHARS", 20))
+
+# Prefix of the model name reused answers are logged under, so they are neither indexed nor learned from
+NEAR_DUP_MODEL_NAME = "near-dup"
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 4
+_EMPTY = 0xFFFFFFFF
+
+_MENTION_OR_URL = re.compile(r"@\w+|#|https?://\S+|www\.\S+")
+_NON_WORD = re.compile(r"[\W\d_]+")
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = Counter("near_duplicate_lookups_total", "Near-duplicate index lookups by outcome.", ("result",))
+
+def shingles(text:str) -> set[str]:
+    """
+    Character shingles of a comment stripped of mentions, links, digits, emojis and punctuation.
+
+    Args:
+        text (str): raw comment
+
+    Returns:
+        shingles (set[str]): distinct SHINGLE_SIZE-character substrings, empty for comments shorter than NEAR_DUP_MIN_CHARS
+    """
+    cleaned = _MENTION_OR_URL.sub(" ", normalize_text(text))
+    cleaned = _NON_WORD.sub(" ", cleaned).strip()
+    if len(cleaned) < NEAR_DUP_MIN_CHARS:
+        return set()
+    return {cleaned[i:i + SHINGLE_SIZE] for i in range(len(cleaned) - SHINGLE_SIZE + 1)}
+
+def minhash(text:str) -> Optional[array]:
+    """
+    One-permutation MinHash signature of a comment, None when it is too short to compare.
+
+    Args:
+        text (str): raw comment
+
+    Returns:
+        signature (array | None): NUM_PERM unsigned 32-bit minima
+    """
+    grams = shingles(text)
+    if not grams:
+        return None
+    signature = [_EMPTY] * NUM_PERM
+    for gram in grams:
+        value = zlib.crc32(gram.encode("utf-8"))
+        slot = value % NUM_PERM
+        if value < signature[slot]:
+            signature[slot] = value
+    # Fill empty bins from the next filled one, so short comments still compare bin by bin
+    filled = [i for i, value in enumerate(signature) if value != _EMPTY]
+    for i in range(NUM_PERM):
+        if signature[i] == _EMPTY:
+            donor = next((j for j in filled if j > i), filled[0])
+            signature[i] = signature[donor] ^ (i * 0x9E3779B1 & _EMPTY)
+    return array("I", signature)
+
+def similarity(a:array, b:array) -> float:
+    """Estimated Jaccard similarity of two signatures: the share of equal bins."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+def near_duplicate_model_name(model:str) -> str:
+    """Model name a reused answer is logged under, e.g. "near-dup:mistral" for scores first given by mistral."""
+    return f"{NEAR_DUP_MODEL_NAME}:{model}"
+
+@dataclass
+class NearDuplicate:
+    """An earlier comment close enough to reuse its scores."""
+    scores: dict
+    similarity: float
+    model: str
+
+class NearDuplicateIndex:
+    """
+    In-memory MinHash/LSH index of comments and the scores the LLM gave them.
+
+    Args:
+        threshold (float, optional): least estimated Jaccard similarity to reuse scores. Defaults to NEAR_DUP_THRESHOLD.
+        max_entries (int, optional): most comments kept, the oldest are dropped first. Defaults to NEAR_DUP_MAX_ENTRIES.
+    """
+
+    def __init__(self, threshold:float=NEAR_DUP_THRESHOLD, max_entries:int=NEAR_DUP_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._buckets = [{} for _ in range(BANDS)]
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.counters = {"reused": 0, "missed": 0, "too_short": 0, "added": 0, "evicted": 0}
+
+    @staticmethod
+    def _band_keys(signature:array) -> list[int]:
+        rows = NUM_PERM // BANDS
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(BANDS)]
+
+    def _best_match(self, signature:array, model:str) -> Optional[NearDuplicate]:
+        candidates = set()
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(buckets.get(key, ()))
+        best = None
+        for entry_id in candidates:
+            entry_signature, scores, entry_model = self._entries[entry_id]
+            if entry_model != model:
+                continue
+            score = similarity(signature, entry_signature)
+            if score >= self.threshold and (best is None or score > best.similarity):
+                best = NearDuplicate(dict(scores), score, entry_model)
+        return best
+
+    def lookup(self, text:str, model:str) -> Optional[NearDuplicate]:
+        """
+        Find an earlier comment scored by `model` that is a near duplicate of `text`.
+
+        Args:
+            text (str): raw comment
+            model (str): LLM the request would go to; scores of other models are not reused
+
+        Returns:
+            match (NearDuplicate | None): the most similar earlier comment above the threshold
+        """
+        signature = minhash(text)
+        if signature is None:
+            result = "too_short"
+            match = None
+        else:
+            with self._lock:
+                match = self._best_match(signature, model)
+            result = "reused" if match is not None else "missed"
+        with self._lock:
+            self.counters[result] += 1
+        LOOKUPS.inc(result=result)
+        return match
+
+    def add(self, text:str, model:str, scores:dict) -> bool:
+        """
+        Index the LLM's scores of a comment, unless a near duplicate is indexed already.
+
+        Args:
+            text (str): raw comment
+            model (str): LLM that scored it
+            scores (dict): 'sentiment_score' and 'offensive_score'
+
+        Returns:
+            added (bool): whether the comment was indexed
+        """
+        signature = minhash(text)
+        if signature is None:
+            return False
+        scores = {"sentiment_score": scores["sentiment_score"], "offensive_score": scores["offensive_score"]}
+        with self._lock:
+            if self._best_match(signature, model) is not None:
+                return False
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (signature, scores, model)
+            for buckets, key in zip(self._buckets, self._band_keys(signature)):
+                buckets.setdefault(key, set()).add(entry_id)
+            self.counters["added"] += 1
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+        return True
+
+    def _evict_oldest(self):
+        entry_id, (signature, _, _) = self._entries.popitem(last=False)
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            bucket = buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del buckets[key]
+        self.counters["evicted"] += 1
+
+    def rebuild(self, db_path:str) -> int:
+        """
+        Index the latest LLM-scored comments of the logs table.
+
+        Args:
+            db_path (str): SQLite database holding the logs table
+
+        Returns:
+            added (int): comments indexed
+        """
+        from fast_classifier import FAST_MODEL_NAME
+
+        con = sqlite3.connect(db_path)
+        try:
+            rows = con.execute("""
+                SELECT input, model, sentiment_score, offensive_score FROM logs
+                WHERE model IS NOT NULL AND model != ? AND model NOT LIKE ?
+                  AND sentiment_score BETWEEN 1 AND 5 AND offensive_score BETWEEN 1 AND 5
+                ORDER BY timestamp DESC LIMIT ?
+            """, (FAST_MODEL_NAME, f"{NEAR_DUP_MODEL_NAME}%", self.max_entries)).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Could not rebuild the near-duplicate index: {e}")
+            return 0
+        finally:
+            con.close()
+        # Oldest first, so the newest comments are the last to be evicted
+        added = sum(self.add(text, model, {"sentiment_score": sentiment, "offensive_score": offensive})
+                    for text, model, sentiment, offensive in reversed(rows))
+        logger.info(f"Near-duplicate index rebuilt with {added} of {len(rows)} logged comments")
+        return added
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            entries = len(self._entries)
+        looked_up = counters["reused"] + counters["missed"]
+        return dict(counters, entries=entries, reuse_rate=counters["reused"] / looked_up if looked_up else 0.0)
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_near_duplicate_index(db_path:Optional[str]=None) -> Optional[NearDuplicateIndex]:
+    """
+    Create the index once and rebuild it from `db_path` in a background thread. None when disabled.
+
+    Args:
+        db_path (str, optional): logs database to rebuild from. Defaults to DB_PATH.
+    """
+    global _index
+    if not NEAR_DUP_ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if db_path is None:
+                    from utils import DB_PATH
+                    db_path = DB_PATH
+                index = NearDuplicateIndex()
+                threading.Thread(target=index.rebuild, args=(db_path,), name="near-dup-rebuild", daemon=True).start()
+                _index = index
+    return _index
+
+Gauge("near_duplicate_index_entries", "Comments in the near-duplicate index.", fn=lambda: len(_index) if _index else 0)
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import random
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+LOCAL_MODEL = os.environ.get("LOCAL_MODEL")
+URL = os.environ.get("URL")
+OLLAMA_CONCURRENCY = int(os.environ.get("OLLAMA_CONCURRENCY", 8))
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 120))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", 3))
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class OllamaError(Exception):
+    """Raised when Ollama returns an error body or keeps failing after all retries."""
+
+class AsyncOllamaClient:
+    """
+    Asyncio client for the Ollama `/api/generate` endpoint.
+    See https://github.com/jmorganca/ollama.
+
+    Connections are pooled and kept alive across calls, at most `concurrency` requests are in
+    flight at once, and transport errors or 429/5xx responses are retried with exponential backoff.
+
+    Args:
+        base_url (str, optional): Ollama server URL. Defaults to the URL env var.
+        model (str, optional): Ollama model type. Defaults to the LOCAL_MODEL env var.
+        concurrency (int, optional): maximum number of in-flight requests. Defaults to OLLAMA_CONCURRENCY.
+        timeout (float, optional): per-request timeout in seconds. Defaults to OLLAMA_TIMEOUT.
+        max_retries (int, optional): retries after the first attempt. Defaults to OLLAMA_MAX_RETRIES.
+        backoff (float, optional): base delay in seconds between retries. Defaults to 0.5.
+    """
+
+    def __init__(self, base_url:str=URL, model:str=LOCAL_MODEL, concurrency:int=OLLAMA_CONCURRENCY,
+                 timeout:float=OLLAMA_TIMEOUT, max_retries:int=OLLAMA_MAX_RETRIES, backoff:float=0.5):
+        self.base_url = base_url
+        self.model = model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool and semaphore belong to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=10),
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client
+
+    async def generate(self, prompt:str, **options) -> str:
+        """
+        Send a single prompt to Ollama and return the response.
+
+        Args:
+            prompt (str): prompt to send to the local API
+            **options: extra fields merged into the request body, e.g. `system`, `options` or `format`
+
+        Returns:
+            response_content (str): response from local ollama API
+        """
+        client = self._get_client()
+        data = {"prompt": prompt, "model": self.model, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE, **options}
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.post("/api/generate", json=data)
+                    if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                        await self._sleep(attempt)
+                        continue
+                    response.raise_for_status()
+                    body = response.json()
+                    break
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    await self._sleep(attempt)
+
+        if "error" in body:
+            raise OllamaError(body["error"])
+        response_content = body.get("response", "").strip()
+        return response_content
+
+    async def gather(self, prompts:list[str], **options) -> list:
+        """
+        Send many prompts concurrently, bounded by `concurrency`.
+
+        Args:
+            prompts (list[str]): prompts to send
+            **options: extra fields merged into every request body
+
+        Returns:
+            responses (list): response string per prompt, or the raised exception for failed prompts
+        """
+        return await asyncio.gather(*(self.generate(prompt, **options) for prompt in prompts), return_exceptions=True)
+
+    async def _sleep(self, attempt:int):
+        await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Optional
+
+from background_loop import run_coroutine
+from dotenv import load_dotenv
+
+load_dotenv()
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL")
+OPENAI_RPM = float(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = float(os.environ.get("OPENAI_TPM", 60_000))
+OPENAI_CONCURRENCY = int(os.environ.get("OPENAI_CONCURRENCY", 16))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
+OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", 100))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_reset_duration(value:str) -> float:
+    """
+    Parse an OpenAI rate-limit reset header such as "1s", "6m0s" or "120ms" into seconds.
+
+    Args:
+        value (str): header value
+
+    Returns:
+        seconds (float): time until the limit resets
+    """
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_PART.findall(value or ""))
+
+def estimate_tokens(prompt:str, max_tokens:int=OPENAI_MAX_TOKENS) -> int:
+    """
+    Estimate how many tokens a chat request counts against the tokens-per-minute limit.
+    OpenAI counts the prompt plus `max_tokens`, so both are included. Uses tiktoken when it is
+    installed and falls back to roughly 4 characters per token otherwise.
+
+    Args:
+        prompt (str): user message
+        max_tokens (int, optional): completion cap sent with the request. Defaults to OPENAI_MAX_TOKENS.
+
+    Returns:
+        tokens (int): estimated token count
+    """
+    try:
+        import tiktoken
+        prompt_tokens = len(tiktoken.get_encoding("cl100k_base").encode(prompt))
+    except ImportError:
+        prompt_tokens = len(prompt) // 4 + 1
+    # Per-message overhead of the chat format
+    return prompt_tokens + 7 + max_tokens
+
+class RateLimitScheduler:
+    """
+    Pace requests against requests-per-minute and tokens-per-minute budgets.
+
+    Both budgets are token buckets refilled continuously. Callers `acquire` the estimated cost
+    before each request and wait when a bucket is empty. Rate-limit headers from responses
+    tighten the buckets to what the server reports, and a 429 blocks everybody until reset.
+
+    Args:
+        rpm (float, optional): requests per minute. Defaults to OPENAI_RPM.
+        tpm (float, optional): tokens per minute. Defaults to OPENAI_TPM.
+    """
+
+    def __init__(self, rpm:float=OPENAI_RPM, tpm:float=OPENAI_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.blocked_until = 0.0
+        self._updated_at = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+        self.counters = {"requests": 0, "tokens": 0, "waits": 0, "wait_seconds": 0.0, "rate_limited": 0}
+
+    def _refill(self, now:float):
+        elapsed = now - self._updated_at
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self._updated_at = now
+
+    async def acquire(self, tokens:int):
+        """Wait until one request and `tokens` tokens fit in the budgets, then consume them."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        tokens = min(tokens, self.tpm)
+        # The lock keeps waiting callers in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = max(
+                    self.blocked_until - now,
+                    (1 - self.requests) * 60 / self.rpm,
+                    (tokens - self.tokens) * 60 / self.tpm,
+                )
+                if wait <= 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    self.counters["requests"] += 1
+                    self.counters["tokens"] += tokens
+                    return
+                self.counters["waits"] += 1
+                self.counters["wait_seconds"] += wait
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated:int, actual:int):
+        """Give back (or charge) the difference between the estimated and the actual token usage."""
+        self.tokens = min(self.tpm, self.tokens + estimated - actual)
+
+    def update_from_headers(self, headers):
+        """Tighten the buckets to the remaining budget reported by `x-ratelimit-*` response headers."""
+        now = time.monotonic()
+        self._refill(now)
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            remaining = float(remaining)
+            setattr(self, kind, min(getattr(self, kind), remaining))
+            if remaining <= 0:
+                reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                self.blocked_until = max(self.blocked_until, now + reset)
+
+    def block(self, seconds:float):
+        """Stop all requests for `seconds`, e.g. after a 429."""
+        self.counters["rate_limited"] += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class AsyncOpenAIBackend:
+    """
+    Async OpenAI chat backend paced by a RateLimitScheduler.
+
+    Args:
+        model (str, optional): OpenAI model type. Defaults to the OPENAI_MODEL env var.
+        scheduler (RateLimitScheduler, optional): shared budget. Defaults to a new one from env settings.
+        concurrency (int, optional): maximum in-flight requests. Defaults to OPENAI_CONCURRENCY.
+        max_retries (int, optional): retries on 429 and transient errors. Defaults to OPENAI_MAX_RETRIES.
+        max_tokens (int, optional): completion cap per request. Defaults to OPENAI_MAX_TOKENS.
+    """
+
+    def __init__(self, model:str=OPENAI_MODEL, scheduler:Optional[RateLimitScheduler]=None,
+                 concurrency:int=OPENAI_CONCURRENCY, max_retries:int=OPENAI_MAX_RETRIES, max_tokens:int=OPENAI_MAX_TOKENS):
+        self.model = model
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_tokens = max_tokens
+        self._client = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self):
+        # Created lazily on the running loop; retries are handled here so they respect the scheduler.
+        # openai is imported here so local-only processes never pay for it
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client
+
+    async def complete(self, prompt:str, temperature:int=0, system:Optional[str]=None) -> str:
+        """
+        Send a single prompt to the OpenAI API and return the response.
+
+        Args:
+            prompt (str): prompt to send to the API
+            temperature (int, optional): degree of randomness of the model's output. Defaults to 0.
+            system (str, optional): system message sent before the prompt. Keep it identical across calls
+                so the provider's prompt cache can reuse it. Defaults to None.
+
+        Returns:
+            content (str): response from the OpenAI API
+        """
+        import openai
+        client = self._get_client()
+        messages = [{"role": "user", "content": prompt}]
+        if system is not None:
+            messages.insert(0, {"role": "system", "content": system})
+        estimated = estimate_tokens(prompt if system is None else system + prompt, self.max_tokens)
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.scheduler.acquire(estimated)
+                try:
+                    raw = await client.chat.completions.with_raw_response.create(
+                        model=self.model,
+                        response_format={"type": "json_object"},
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=self.max_tokens,
+                    )
+                except openai.RateLimitError as e:
+                    retry_after = e.response.headers.get("retry-after")
+                    self.scheduler.block(float(retry_after) if retry_after else 2 ** attempt)
+                    if attempt == self.max_retries:
+                        raise
+                    continue
+                except (openai.APIConnectionError, openai.InternalServerError):
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(0.5 * 2 ** attempt * (1 + random.random()))
+                    continue
+
+                self.scheduler.update_from_headers(raw.headers)
+                response = raw.parse()
+                if response.usage is not None:
+                    self.scheduler.settle(estimated, response.usage.total_tokens)
+                return response.choices[0].message.content
+
+    async def gather(self, prompts:list[str], system:Optional[str]=None) -> list:
+        """
+        Send many prompts concurrently within the rate-limit budgets.
+
+        Args:
+            prompts (list[str]): prompts to send
+            system (str, optional): system message sent before every prompt. Defaults to None.
+
+        Returns:
+            responses (list): response string per prompt, or the raised exception for failed prompts
+        """
+        return await asyncio.gather(*(self.complete(prompt, system=system) for prompt in prompts), return_exceptions=True)
+
+openai_backend = AsyncOpenAIBackend()
+
+def get_scheduled_openai_completion(prompt:str, system:Optional[str]=None) -> str:
+    """Blocking wrapper around `openai_backend.complete` for synchronous callers such as Gradio handlers."""
+    return run_coroutine(openai_backend.complete(prompt, system=system))
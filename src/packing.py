@@ -0,0 +1,94 @@
+"""
+Score several comments with one LLM call.
+
+The fixed scoring instructions make up most of the prompt for short comments, so
+packing K numbered comments into one prompt saves most of the prompt tokens and latency.
+Items whose scores are missing or invalid in the packed answer are re-sent on their own.
+"""
+import json
+import os
+from typing import Callable
+
+from local_openai_sentiment_analysis import SCORING_SCALES, SYSTEM_PROMPT, build_comment_prompt, parse_response
+from structured_output import validate_scores
+
+LOCAL_PACK_SIZE = int(os.environ.get("LOCAL_PACK_SIZE", 4))
+OPENAI_PACK_SIZE = int(os.environ.get("OPENAI_PACK_SIZE", 10))
+
+def build_packed_prompt(comments:list[str]) -> str:
+    """
+    Build one prompt asking for the scores of several numbered comments.
+
+    Args:
+        comments (list[str]): comments to score, numbered from 1 in the prompt
+
+    Returns:
+        prompt (str): prompt asking for a JSON object with a 'results' array
+    """
+    numbered = "\n".join(f"    {i}: <{comment}>" for i, comment in enumerate(comments, start=1))
+    prompt = f"""
+    Your task is to perform the following actions for each of the numbered social media comments below, each delimited by <>:
+
+{SCORING_SCALES}
+
+    Format your response as a JSON object with the key 'results' holding an array with one \
+    object per comment, each with the keys 'id', 'sentiment_score' and 'offensive_score'.
+    Make your response as short as possible without any additional explanation.
+
+    Comments:
+{numbered}
+    """
+    return prompt
+
+def parse_packed_response(response:str, n:int) -> dict[int, dict]:
+    """
+    Parse a packed response, keeping only well-formed items.
+
+    Args:
+        response (str): raw model response, either {'results': [...]} or a bare JSON array
+        n (int): number of comments in the packed prompt
+
+    Returns:
+        scores (dict[int, dict]): validated scores by 1-based comment id
+    """
+    try:
+        parsed = parse_response(response)
+    except ValueError:
+        return {}
+    items = parsed.get("results", []) if isinstance(parsed, dict) else parsed
+    scores = {}
+    for item in items if isinstance(items, list) else []:
+        try:
+            item_id = int(item["id"])
+            if 1 <= item_id <= n:
+                scores[item_id] = validate_scores(item)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return scores
+
+def complete_packed(comments:list[str], complete_many:Callable[..., list], pack_size:int) -> list:
+    """
+    Score comments `pack_size` at a time and re-send missing or malformed items individually.
+
+    Args:
+        comments (list[str]): comments to score
+        complete_many (Callable[..., list]): sends prompts concurrently with an optional `system` prompt,
+            returning a response or exception per prompt
+        pack_size (int): comments per packed prompt
+
+    Returns:
+        responses (list): a JSON response string per comment, or the exception of its individual retry
+    """
+    packs = [list(range(start, min(start + pack_size, len(comments)))) for start in range(0, len(comments), pack_size)]
+    responses = [None] * len(comments)
+    packed_responses = complete_many([build_packed_prompt([comments[i] for i in pack]) for pack in packs])
+    for pack, response in zip(packs, packed_responses):
+        scores = {} if isinstance(response, Exception) else parse_packed_response(response, len(pack))
+        for item_id, item_scores in scores.items():
+            responses[pack[item_id - 1]] = json.dumps(item_scores)
+
+    missing = [i for i, response in enumerate(responses) if response is None]
+    retries = complete_many([build_comment_prompt(comments[i]) for i in missing], system=SYSTEM_PROMPT)
+    for i, response in zip(missing, retries):
+        responses[i] = response
+    return responses
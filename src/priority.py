@@ -0,0 +1,141 @@
+"""
+Priority classes, deadlines and per-class quotas for the translation and completion stages.
+
+Live moderation requests ("interactive") and backfills ("bulk") share the translator and the
+LLM. Every call into a stage first takes one of the stage's slots. Free slots go to the waiting
+interactive requests first, earliest deadline first, and bulk work may hold at most
+SCHEDULER_BULK_SHARE of a stage's slots, so there is always room for interactive traffic while
+bulk jobs use the rest. A request still waiting when its deadline passes is shed with
+`DeadlineExceeded`; bulk work without a deadline is only deferred.
+
+    with stage_slot("completion", BULK, deadline):
+        response = get_local_completion(prompt)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from itertools import count
+from typing import Optional
+
+from metrics import Counter, Gauge, Histogram
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_TRANSLATION_SLOTS = int(os.environ.get("SCHEDULER_TRANSLATION_SLOTS", 16))
+SCHEDULER_COMPLETION_SLOTS = int(os.environ.get("SCHEDULER_COMPLETION_SLOTS", 16))
+SCHEDULER_BULK_SHARE = float(os.environ.get("SCHEDULER_BULK_SHARE", 0.5))
+# Seconds a request of each class may take before waiting work is shed, 0 waits as long as needed
+SCHEDULER_INTERACTIVE_DEADLINE_S = float(os.environ.get("SCHEDULER_INTERACTIVE_DEADLINE_S", 0))
+SCHEDULER_BULK_DEADLINE_S = float(os.environ.get("SCHEDULER_BULK_DEADLINE_S", 0))
+
+WAIT_SECONDS = Histogram("scheduler_wait_seconds", "Time spent waiting for a stage slot.", ("stage", "priority"))
+SHED = Counter("scheduler_shed_total", "Requests dropped because their deadline passed while waiting.", ("stage", "priority"))
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline passes before a stage slot is free."""
+
+def default_deadline(priority:str) -> Optional[float]:
+    """Deadline, on the `time.monotonic()` clock, of a request of `priority` starting now. None for no deadline."""
+    seconds = SCHEDULER_INTERACTIVE_DEADLINE_S if priority == INTERACTIVE else SCHEDULER_BULK_DEADLINE_S
+    return time.monotonic() + seconds if seconds > 0 else None
+
+class StageScheduler:
+    """
+    Hand out the slots of one stage by priority class, deadline and per-class quota.
+
+    Args:
+        stage (str): stage name, e.g. "translation"
+        slots (int): calls into the stage running at once
+        bulk_share (float, optional): share of the slots bulk work may hold. Defaults to SCHEDULER_BULK_SHARE.
+    """
+
+    def __init__(self, stage:str, slots:int, bulk_share:float=SCHEDULER_BULK_SHARE):
+        if slots < 1:
+            raise ValueError("A stage needs at least one slot")
+        self.stage = stage
+        self.slots = slots
+        self.quotas = {INTERACTIVE: slots, BULK: max(1, int(slots * bulk_share))}
+        self.in_use = {priority: 0 for priority in PRIORITIES}
+        self._waiting = []
+        self._seq = count()
+        self._cond = threading.Condition()
+
+    def _next_waiter(self) -> Optional[tuple]:
+        if sum(self.in_use.values()) >= self.slots:
+            return None
+        for waiter in sorted(self._waiting):
+            priority = PRIORITIES[waiter[0]]
+            if self.in_use[priority] < self.quotas[priority]:
+                return waiter
+        return None
+
+    def acquire(self, priority:str=INTERACTIVE, deadline:Optional[float]=None):
+        """
+        Wait for a slot.
+
+        Args:
+            priority (str, optional): one of PRIORITIES. Defaults to INTERACTIVE.
+            deadline (float, optional): `time.monotonic()` time after which waiting is given up. Defaults to None.
+
+        Raises:
+            DeadlineExceeded: the deadline passed before a slot was free
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}, choose from {PRIORITIES}")
+        start = time.monotonic()
+        waiter = (PRIORITIES.index(priority), float("inf") if deadline is None else deadline, next(self._seq))
+        with self._cond:
+            self._waiting.append(waiter)
+            try:
+                while self._next_waiter() != waiter:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        SHED.inc(stage=self.stage, priority=priority)
+                        raise DeadlineExceeded(f"Deadline passed while waiting for {self.stage}")
+                    self._cond.wait(remaining)
+                self.in_use[priority] += 1
+            finally:
+                self._waiting.remove(waiter)
+                # The head of the queue may have changed for the others
+                self._cond.notify_all()
+        WAIT_SECONDS.observe(time.monotonic() - start, stage=self.stage, priority=priority)
+
+    def release(self, priority:str=INTERACTIVE):
+        with self._cond:
+            self.in_use[priority] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority:str=INTERACTIVE, deadline:Optional[float]=None):
+        """Hold a slot for the `with` block, see `acquire`."""
+        self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        with self._cond:
+            waiting = {priority: 0 for priority in PRIORITIES}
+            for waiter in self._waiting:
+                waiting[PRIORITIES[waiter[0]]] += 1
+            return {"slots": self.slots, "quotas": dict(self.quotas), "in_use": dict(self.in_use), "waiting": waiting}
+
+schedulers = {
+    "translation": StageScheduler("translation", SCHEDULER_TRANSLATION_SLOTS),
+    "completion": StageScheduler("completion", SCHEDULER_COMPLETION_SLOTS),
+}
+
+def stage_slot(stage:str, priority:str=INTERACTIVE, deadline:Optional[float]=None):
+    """Slot of a pipeline stage for one call, or a no-op when SCHEDULER_ENABLED=0."""
+    if not SCHEDULER_ENABLED:
+        return nullcontext()
+    return schedulers[stage].slot(priority, deadline)
+
+Gauge("scheduler_waiting_requests", "Requests waiting for a stage slot.", ("stage", "priority"),
+      fn=lambda: {(stage, priority): n for stage, scheduler in schedulers.items()
+                  for priority, n in scheduler.stats()["waiting"].items()})
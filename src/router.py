@@ -0,0 +1,194 @@
+"""
+Route local completions across several Ollama hosts, with OpenAI as the overflow tier.
+
+Each request goes to the healthy host with the fewest outstanding requests. A host whose
+requests keep failing is taken out by a circuit breaker and tried again after a cool-down; a
+background thread also polls `/api/tags` on every host. When even the least busy host is
+expected to answer slower than ROUTER_SLO_MS, or no host is available, the request spills over
+to OpenAI if ROUTER_OVERFLOW=1.
+
+    OLLAMA_URLS="http://gpu-1:11434,http://gpu-2:11434"
+    ROUTER_OVERFLOW=1
+"""
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import requests
+
+from metrics import Counter, Gauge
+from utils import URL
+
+OLLAMA_URLS = [url.strip().rstrip("/") for url in os.environ.get("OLLAMA_URLS", URL or "").split(",") if url.strip()]
+# Requests one Ollama host works on at the same time, as set by OLLAMA_NUM_PARALLEL on the server
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+ROUTER_OVERFLOW = os.environ.get("ROUTER_OVERFLOW", "0") == "1"
+ROUTER_SLO_MS = float(os.environ.get("ROUTER_SLO_MS", 3000))
+ROUTER_HEALTH_INTERVAL = float(os.environ.get("ROUTER_HEALTH_INTERVAL", 10))
+ROUTER_BREAKER_FAILURES = int(os.environ.get("ROUTER_BREAKER_FAILURES", 3))
+ROUTER_BREAKER_COOLDOWN = float(os.environ.get("ROUTER_BREAKER_COOLDOWN", 30))
+
+logger = logging.getLogger(__name__)
+
+ROUTED = Counter("router_requests_total", "Local completions by backend and outcome.", ("backend", "outcome"))
+
+class NoBackendAvailable(Exception):
+    """Raised when no Ollama host can take a request and overflow to OpenAI is off."""
+
+class OllamaBackend:
+    """
+    Routing state of one Ollama host: outstanding requests, latency average and circuit breaker.
+
+    Args:
+        url (str): Ollama server URL
+        parallel (int, optional): requests the host runs at once. Defaults to OLLAMA_NUM_PARALLEL.
+    """
+
+    def __init__(self, url:str, parallel:int=OLLAMA_NUM_PARALLEL):
+        self.url = url
+        self.parallel = parallel
+        self.outstanding = 0
+        # Exponentially weighted moving average of request latency in seconds
+        self.latency = None
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def available(self, now:float) -> bool:
+        """Closed breaker, or open breaker past its cool-down with no probe in flight."""
+        if not self.healthy:
+            return False
+        if self.failures < ROUTER_BREAKER_FAILURES:
+            return True
+        return now >= self.open_until and not self.probing
+
+    def expected_seconds(self) -> float:
+        """Latency a new request can expect, counting the requests queued ahead of it."""
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + self.outstanding // self.parallel)
+
+    def state(self) -> str:
+        if not self.healthy:
+            return "unhealthy"
+        return "open" if self.failures >= ROUTER_BREAKER_FAILURES else "closed"
+
+class BackendRouter:
+    """
+    Least-outstanding-requests balancing over Ollama hosts with OpenAI overflow.
+
+    Args:
+        urls (list[str], optional): Ollama server URLs. Defaults to OLLAMA_URLS.
+        overflow (bool, optional): spill over to OpenAI instead of failing or queueing past the SLO. Defaults to ROUTER_OVERFLOW.
+        slo_ms (float, optional): latency above which a request overflows. Defaults to ROUTER_SLO_MS.
+        health_interval (float, optional): seconds between health checks, 0 disables them. Defaults to ROUTER_HEALTH_INTERVAL.
+    """
+
+    def __init__(self, urls:list[str]=OLLAMA_URLS, overflow:bool=ROUTER_OVERFLOW, slo_ms:float=ROUTER_SLO_MS,
+                 health_interval:float=ROUTER_HEALTH_INTERVAL):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.overflow = overflow
+        self.slo = slo_ms / 1000
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._health_thread = None
+
+    def _choose(self) -> Optional[OllamaBackend]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend.available(now)]
+            if not candidates:
+                return None
+            fewest = min(backend.outstanding for backend in candidates)
+            backend = random.choice([b for b in candidates if b.outstanding == fewest])
+            if self.overflow and backend.expected_seconds() > self.slo:
+                return None
+            backend.outstanding += 1
+            if backend.failures >= ROUTER_BREAKER_FAILURES:
+                # Half-open: this request decides whether the breaker closes again
+                backend.probing = True
+            return backend
+
+    def _finish(self, backend:OllamaBackend, seconds:float, outcome:str):
+        with self._lock:
+            backend.outstanding -= 1
+            backend.probing = False
+            if outcome == "ok":
+                backend.failures = 0
+                backend.latency = seconds if backend.latency is None else 0.8 * backend.latency + 0.2 * seconds
+            elif outcome == "error":
+                backend.failures += 1
+                if backend.failures >= ROUTER_BREAKER_FAILURES:
+                    backend.open_until = time.monotonic() + ROUTER_BREAKER_COOLDOWN
+                    logger.warning(f"Circuit open for {backend.url} after {backend.failures} failures")
+
+    @contextmanager
+    def route(self) -> Iterator[Optional[OllamaBackend]]:
+        """
+        Pick an Ollama host for one request and track the outcome of the `with` block.
+
+        Yields:
+            backend (OllamaBackend | None): host to send the request to, or None to send it to OpenAI instead
+        """
+        self._start_health_checks()
+        backend = self._choose()
+        if backend is None:
+            if not self.overflow:
+                ROUTED.inc(backend="none", outcome="rejected")
+                raise NoBackendAvailable("No healthy Ollama backend available")
+            ROUTED.inc(backend="openai", outcome="overflow")
+            yield None
+            return
+
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield backend
+            outcome = "ok"
+        except GeneratorExit:
+            # The caller stopped streaming, e.g. a closed Gradio tab; not the host's fault
+            outcome = "cancelled"
+            raise
+        finally:
+            self._finish(backend, time.perf_counter() - start, outcome)
+            ROUTED.inc(backend=backend.url, outcome=outcome)
+
+    def _start_health_checks(self):
+        if self._health_thread is None and self.health_interval > 0:
+            with self._lock:
+                if self._health_thread is None:
+                    self._health_thread = threading.Thread(target=self._health_loop, name="router-health", daemon=True)
+                    self._health_thread.start()
+
+    def check_health(self):
+        """Poll `/api/tags` on every host and update whether it takes requests."""
+        for backend in self.backends:
+            try:
+                healthy = requests.get(f"{backend.url}/api/tags", timeout=2).ok
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                if healthy != backend.healthy:
+                    logger.warning(f"Ollama backend {backend.url} is now {'healthy' if healthy else 'unhealthy'}")
+                backend.healthy = healthy
+
+    def _health_loop(self):
+        while True:
+            self.check_health()
+            time.sleep(self.health_interval)
+
+    def stats(self) -> list[dict]:
+        """Outstanding requests, latency average and breaker state of every host."""
+        with self._lock:
+            return [{"url": b.url, "outstanding": b.outstanding, "latency_ms": b.latency * 1000 if b.latency else None,
+                     "state": b.state(), "failures": b.failures} for b in self.backends]
+
+local_router = BackendRouter()
+
+Gauge("router_outstanding_requests", "Requests in flight per Ollama host.", ("backend",),
+      fn=lambda: {(b["url"],): b["outstanding"] for b in local_router.stats()})
@@ -0,0 +1,60 @@
+"""
+Pick the scores out of a streamed model response as the tokens arrive.
+
+Local models often keep writing an explanation after the JSON object closes. `ScoreExtractor`
+watches the stream and reports each score as soon as its value is complete, so the caller can
+show partial results and stop the generation once both scores are known.
+"""
+import json
+import re
+
+SCORE_KEYS = ("sentiment_score", "offensive_score")
+
+# A key, a colon and an integer, optionally quoted. The value counts as complete only once a
+# character that cannot continue the number has arrived, so a split "1" + "2" is never read as 1.
+_SCORE_PATTERN = re.compile(r"""["']?(sentiment_score|offensive_score)["']?\s*:\s*["']?(\d+)(?=[^\d.])""")
+
+class ScoreExtractor:
+    """
+    Incrementally extract 'sentiment_score' and 'offensive_score' from streamed text.
+    Only the first value seen for each key is kept, later mentions in the commentary are ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.scores = {}
+        self._clean = ""
+        self._pos = 0
+
+    def feed(self, chunk:str) -> dict:
+        """
+        Add the next chunk of the response.
+
+        Args:
+            chunk (str): newly streamed text
+
+        Returns:
+            scores (dict): the scores parsed so far
+        """
+        self.text += chunk
+        # Same clean-up as parse_response: models sometimes escape the underscores
+        self._clean += chunk.replace("\\", "")
+        for match in _SCORE_PATTERN.finditer(self._clean, self._pos):
+            self.scores.setdefault(match.group(1), int(match.group(2)))
+            self._pos = match.end()
+        return dict(self.scores)
+
+    def finish(self) -> dict:
+        """Mark the end of the stream, completing a value that was the very last token."""
+        return self.feed(" ") if self._clean else dict(self.scores)
+
+    @property
+    def complete(self) -> bool:
+        """True once both scores have been parsed."""
+        return all(key in self.scores for key in SCORE_KEYS)
+
+    def to_response(self) -> str:
+        """The scores as a JSON object once complete, otherwise the raw text."""
+        if self.complete:
+            return json.dumps({key: self.scores[key] for key in SCORE_KEYS})
+        return self.text.strip()
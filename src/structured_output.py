@@ -0,0 +1,104 @@
+"""
+Structured output for the local model, with validation and a repair parser.
+
+Ollama can constrain decoding to a JSON schema (`format`), so a single-comment prompt only ever
+produces `{"sentiment_score": n, "offensive_score": m}`. Generation is capped at
+`LOCAL_NUM_PREDICT` tokens, which is plenty for that object. Responses that still fail to
+parse, e.g. from an older server or from OpenAI, go through `repair_scores` before the
+request is given up.
+"""
+import json
+import os
+import re
+
+# "schema": JSON schema (Ollama >= 0.5), "json": plain JSON mode, "off": free-form text
+LOCAL_STRUCTURED_OUTPUT = os.environ.get("LOCAL_STRUCTURED_OUTPUT", "schema")
+LOCAL_NUM_PREDICT = int(os.environ.get("LOCAL_NUM_PREDICT", 32))
+
+STRUCTURED_OUTPUT_MODES = ("schema", "json", "off")
+if LOCAL_STRUCTURED_OUTPUT not in STRUCTURED_OUTPUT_MODES:
+    raise ValueError(f"Unknown LOCAL_STRUCTURED_OUTPUT '{LOCAL_STRUCTURED_OUTPUT}'. "
+                     f"Choose one of: {', '.join(STRUCTURED_OUTPUT_MODES)}")
+
+SCORE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sentiment_score": {"type": "integer", "enum": [1, 2, 3, 4, 5]},
+        "offensive_score": {"type": "integer", "enum": [1, 2, 3, 4, 5]},
+    },
+    "required": ["sentiment_score", "offensive_score"],
+    "additionalProperties": False,
+}
+
+# Lenient on separators and quoting: matches sentiment_score": "4", Sentiment score = 4,
+# offensive language score: 2, ...
+_REPAIR_PATTERN = re.compile(
+    r"""(sentiment|offensive)[\s_-]*(?:language[\s_-]*)?score["'\s]*[:=]\s*["']?([1-5])(?![\d.])""",
+    re.IGNORECASE,
+)
+
+def structured_request_fields(mode:str=LOCAL_STRUCTURED_OUTPUT, num_predict:int=LOCAL_NUM_PREDICT) -> dict:
+    """
+    Fields to merge into an Ollama `/api/generate` body for a single-comment prompt.
+
+    Args:
+        mode (str, optional): 'schema', 'json' or 'off'. Defaults to LOCAL_STRUCTURED_OUTPUT.
+        num_predict (int, optional): most tokens generated. Defaults to LOCAL_NUM_PREDICT.
+
+    Returns:
+        fields (dict): `format` and `options`, empty when mode is 'off'
+    """
+    if mode == "off":
+        return {}
+    return {"format": SCORE_SCHEMA if mode == "schema" else "json", "options": {"num_predict": num_predict}}
+
+def validate_scores(res_dict:dict) -> dict:
+    """
+    Check that a parsed response holds integer scores from 1 to 5.
+
+    Args:
+        res_dict (dict): parsed response
+
+    Returns:
+        scores (dict): {'sentiment_score': int, 'offensive_score': int}
+    """
+    scores = {}
+    for key in ("sentiment_score", "offensive_score"):
+        value = int(res_dict[key])
+        if not 1 <= value <= 5:
+            raise ValueError(f"{key} out of range: {value}")
+        scores[key] = value
+    return scores
+
+def repair_scores(response:str) -> dict:
+    """
+    Recover both scores from a response that is not valid JSON, e.g. a truncated object or
+    scores written out in prose.
+
+    Args:
+        response (str): raw model response
+
+    Returns:
+        scores (dict): {'sentiment_score': int, 'offensive_score': int}
+    """
+    found = {}
+    for match in _REPAIR_PATTERN.finditer(response.replace("\\", "")):
+        found.setdefault(f"{match.group(1).lower()}_score", int(match.group(2)))
+    if len(found) < 2:
+        raise ValueError(f"Could not find both scores in response: {response[:200]!r}")
+    return validate_scores(found)
+
+def parse_scores(response:str) -> dict:
+    """
+    Parse and validate a single-comment response, falling back to `repair_scores`.
+
+    Args:
+        response (str): raw response from the local or OpenAI model
+
+    Returns:
+        scores (dict): {'sentiment_score': int, 'offensive_score': int}
+    """
+    try:
+        return validate_scores(json.loads(response.replace("\\", "")))
+    except (ValueError, KeyError, TypeError):
+        return repair_scores(response)
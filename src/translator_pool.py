@@ -0,0 +1,274 @@
+"""
+Translate in a pool of worker processes that share one copy of the model weights.
+
+A single PyTorch model called from many threads either fights over its intra-op threads or
+oversubscribes the cores. With TRANSLATOR_WORKERS=N, translation batches are sent through a
+queue to N worker processes instead. Each worker runs `torch.set_num_threads` with its own
+share of the cores and is pinned to those cores.
+
+The weights are loaded once. A spawned pool process loads the translator and then forks the
+workers, so they inherit the parameters copy-on-write. Parameters are never written during
+inference, so the workers keep sharing the same pages and N workers cost about one model's
+RAM. The pool process itself runs no inference, and it loads with a single thread, so forking
+it is safe. Translators that cannot be forked after loading (`fork_safe = False`, the ONNX
+backend) are loaded by every worker instead.
+
+A worker that crashes fails the batch it was translating right away and is restarted. A worker
+that dies while loading is restarted with exponential backoff, and is given up on after
+TRANSLATOR_MAX_START_FAILURES attempts in a row; once no worker is left, pending and new batches fail.
+"""
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from metrics import Gauge
+
+TRANSLATOR_WORKERS = int(os.environ.get("TRANSLATOR_WORKERS", 0))
+# Torch threads per worker, defaults to an equal share of the available cores
+TRANSLATOR_WORKER_THREADS = os.environ.get("TRANSLATOR_WORKER_THREADS")
+TRANSLATOR_PIN_CPUS = os.environ.get("TRANSLATOR_PIN_CPUS", "1") == "1"
+TRANSLATOR_POOL_TIMEOUT = float(os.environ.get("TRANSLATOR_POOL_TIMEOUT", 120))
+TRANSLATOR_MAX_START_FAILURES = int(os.environ.get("TRANSLATOR_MAX_START_FAILURES", 5))
+
+# Values of a worker's slot in the shared `current` array besides the id of the batch it is translating
+_IDLE = -1
+_LOADING = -2
+_MAX_RESTART_DELAY = 60
+
+logger = logging.getLogger(__name__)
+
+def available_cpus() -> list[int]:
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def worker_cpus(index:int, threads:int, cpus:list[int]) -> list[int]:
+    """The `threads` CPUs of worker `index`, wrapping around when there are more threads than CPUs."""
+    return [cpus[(index * threads + i) % len(cpus)] for i in range(threads)]
+
+def _set_threads(threads:int, cpus:Optional[list[int]]=None):
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already set, or parallel work has run in this process
+        pass
+
+def _worker(index:int, translator, loader:Callable, name:str, threads:int, cpus:Optional[list[int]],
+            requests:multiprocessing.Queue, results:multiprocessing.Queue, current):
+    _set_threads(threads, cpus)
+    if translator is None:
+        translator = loader(name)
+    current[index] = _IDLE
+    results.put(("ready", index, None))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, articles = request
+        # Shared memory survives a crash, so the pool process can tell which batch was lost
+        current[index] = request_id
+        try:
+            results.put(("done", request_id, (translator.translate_batch(articles), None)))
+        except Exception as e:
+            results.put(("done", request_id, (None, f"{type(e).__name__}: {e}")))
+        current[index] = _IDLE
+
+def _pool_main(name:str, loader:Callable, workers:int, threads:int, pin_cpus:bool,
+               requests:multiprocessing.Queue, results:multiprocessing.Queue, current):
+    # Load with one thread, so no OpenMP pool exists yet when the workers are forked
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    _set_threads(1)
+    try:
+        translator = loader(name)
+    except Exception as e:
+        results.put(("stopped", None, f"loading {name} failed: {type(e).__name__}: {e}"))
+        raise
+    if not getattr(translator, "fork_safe", True):
+        translator = None
+
+    cpus = available_cpus()
+    fork = multiprocessing.get_context("fork")
+
+    def start(index:int) -> multiprocessing.Process:
+        current[index] = _LOADING
+        process = fork.Process(target=_worker, name=f"translator-{name}-{index}",
+                               args=(index, translator, loader, name, threads,
+                                     worker_cpus(index, threads, cpus) if pin_cpus else None, requests, results, current))
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(workers)]
+    start_failures = [0] * workers
+    restart_at = {}
+    given_up = set()
+    # Restart workers that crash; a clean exit means the pool was closed
+    while restart_at or any(process.is_alive() for process in processes):
+        for index, process in enumerate(processes):
+            if index in given_up:
+                continue
+            if index in restart_at:
+                if time.monotonic() >= restart_at[index]:
+                    del restart_at[index]
+                    processes[index] = start(index)
+                continue
+            process.join(timeout=1 / workers)
+            if process.exitcode in (None, 0):
+                continue
+            request_id = current[index]
+            current[index] = _IDLE
+            if request_id >= 0:
+                # Fail the lost batch now instead of letting its caller wait for the timeout
+                results.put(("done", request_id, (None, f"worker {process.name} exited with {process.exitcode}")))
+            start_failures[index] = start_failures[index] + 1 if request_id == _LOADING else 0
+            if start_failures[index] >= TRANSLATOR_MAX_START_FAILURES:
+                logger.error(f"Translator worker {process.name} failed to start {start_failures[index]} times, giving up on it")
+                given_up.add(index)
+                continue
+            delay = min(_MAX_RESTART_DELAY, 2 ** start_failures[index]) if start_failures[index] else 0
+            logger.warning(f"Translator worker {process.name} exited with {process.exitcode}, restarting it in {delay}s")
+            restart_at[index] = time.monotonic() + delay
+    if len(given_up) == workers:
+        results.put(("stopped", None, f"every {name} worker failed to start"))
+
+class TranslatorPool:
+    """
+    Worker processes translating batches for one translator.
+
+    Args:
+        name (str): translator name, one of translators.TRANSLATORS
+        workers (int, optional): worker processes. Defaults to TRANSLATOR_WORKERS.
+        threads (int, optional): torch threads per worker. Defaults to TRANSLATOR_WORKER_THREADS, or an equal share of the cores.
+        pin_cpus (bool, optional): pin every worker to its own cores. Defaults to TRANSLATOR_PIN_CPUS.
+        loader (Callable[[str], object], optional): loads a translator by name in the pool process. Defaults to translators.load_translator.
+    """
+
+    def __init__(self, name:str, workers:int=TRANSLATOR_WORKERS, threads:Optional[int]=None,
+                 pin_cpus:bool=TRANSLATOR_PIN_CPUS, loader:Optional[Callable]=None):
+        if workers < 1:
+            raise ValueError("A translator pool needs at least one worker")
+        if loader is None:
+            from translators import load_translator
+            loader = load_translator
+        if threads is None:
+            threads = int(TRANSLATOR_WORKER_THREADS) if TRANSLATOR_WORKER_THREADS else max(1, len(available_cpus()) // workers)
+        self.name = name
+        self.workers = workers
+        self.threads = threads
+        # Spawned, so the pool process starts without the threads and locks of this one
+        context = multiprocessing.get_context("spawn")
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._pending = {}
+        self._stopped = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.ready_workers = 0
+        current = context.Array("q", [_LOADING] * workers, lock=False)
+        self._process = context.Process(target=_pool_main, name=f"translator-pool-{name}",
+                                        args=(name, loader, workers, threads, pin_cpus, self._requests, self._results, current))
+        self._process.start()
+        threading.Thread(target=self._collect, name=f"translator-pool-{name}-results", daemon=True).start()
+        atexit.register(self.close)
+
+    def _collect(self):
+        while True:
+            try:
+                kind, key, payload = self._results.get()
+            except (EOFError, OSError):
+                return
+            if kind == "ready":
+                with self._lock:
+                    self.ready_workers += 1
+                self._ready.set()
+                continue
+            if kind == "stopped":
+                logger.error(f"Translator pool {self.name} stopped: {payload}")
+                with self._lock:
+                    self._stopped = payload
+                    pending, self._pending = self._pending, {}
+                for future in pending.values():
+                    future.set_exception(RuntimeError(f"Translator pool {self.name} stopped: {payload}"))
+                # Wake up callers of wait_ready
+                self._ready.set()
+                continue
+            with self._lock:
+                future = self._pending.pop(key, None)
+            if future is None:
+                continue
+            eng, error = payload
+            if error is None:
+                future.set_result(eng)
+            else:
+                future.set_exception(RuntimeError(f"Translation failed in worker: {error}"))
+
+    def wait_ready(self, timeout:Optional[float]=None) -> bool:
+        """Block until at least one worker has loaded the translator. False on timeout or when the pool stopped."""
+        return self._ready.wait(timeout) and self._stopped is None
+
+    def translate_batch(self, articles:list[str]) -> list[str]:
+        """
+        Translate a batch on the next free worker.
+
+        Args:
+            articles (list[str]): turkish inputs
+
+        Returns:
+            eng (list[str]): english outputs, in the same order as `articles`
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped is not None or not self._process.is_alive():
+                raise RuntimeError(f"Translator pool {self.name} is not running")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        self._requests.put((request_id, list(articles)))
+        try:
+            return future.result(timeout=TRANSLATOR_POOL_TIMEOUT)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def close(self, timeout:float=10):
+        """Stop the workers once they have finished the queued batches."""
+        if self._process.is_alive():
+            for _ in range(self.workers):
+                self._requests.put(None)
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_translator_pool(name:str) -> TranslatorPool:
+    """Start the pool for a translator once, on first use."""
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = TranslatorPool(name)
+    return pool
+
+Gauge("translator_pool_in_flight", "Translation batches sent to a worker pool and not answered yet.", ("translator",),
+      fn=lambda: {(name,): pool.in_flight() for name, pool in list(_pools.items())})
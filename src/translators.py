@@ -0,0 +1,327 @@
+"""
+Turkish to English translators.
+
+TRANSLATORS maps the names accepted by `sentiment_analyzer` to translator classes:
+- nllb: facebook:nllb-200-distilled-600M, on the CPU backend picked by TRANSLATOR_BACKEND
+- mbart: facebook:mbart-large-50-many-to-many-mmt
+- seamless: facebook:hf-seamless-m4t-large, text-to-text only
+
+The NLLB backends share the tokenizer and generation settings and differ in how the model
+is executed on CPU:
+- torch: full-precision PyTorch model (the original setup)
+- int8: PyTorch model with its Linear layers dynamically quantized to int8
+- onnx: ONNX Runtime export with encoder/decoder sessions, exported once and cached on disk
+
+Long comments are split into sentences. All segments of a batch are sorted by length and
+translated in buckets of similar length, each with an output limit scaled to its longest
+input, then put back together in order. Cost grows with the length of the text instead of
+being cut off at a fixed number of tokens.
+
+Check an NLLB backend against the fp32 baseline with:
+    python translators.py --backend int8
+"""
+import argparse
+import difflib
+import os
+import re
+import time
+
+NLLB_MODEL = "facebook/nllb-200-distilled-600M"
+MBART_MODEL = "facebook/mbart-large-50-many-to-many-mmt"
+SEAMLESS_MODEL = "facebook/hf-seamless-m4t-large"
+TRANSLATOR_BACKEND = os.environ.get("TRANSLATOR_BACKEND", "torch")
+ONNX_CACHE_DIR = os.environ.get("ONNX_CACHE_DIR", "../models/nllb-200-distilled-600M-onnx")
+TRANSLATE_MAX_SEGMENT_CHARS = int(os.environ.get("TRANSLATE_MAX_SEGMENT_CHARS", 300))
+TRANSLATE_BUCKET_SIZE = int(os.environ.get("TRANSLATE_BUCKET_SIZE", 16))
+# Bump whenever translation output changes so cached translations of the old version are not reused
+TRANSLATION_VERSION = "2"
+
+# Output tokens allowed per source token, plus a constant for very short segments
+LENGTH_RATIO = 1.5
+LENGTH_MARGIN = 10
+
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\s*\n+\s*")
+
+def split_sentences(text:str, max_chars:int=TRANSLATE_MAX_SEGMENT_CHARS) -> list[str]:
+    """
+    Split a comment into sentences, breaking sentences longer than `max_chars` at a comma or space.
+
+    Args:
+        text (str): turkish comment
+        max_chars (int, optional): longest segment. Defaults to TRANSLATE_MAX_SEGMENT_CHARS.
+
+    Returns:
+        segments (list[str]): non-empty segments in order, [text] for empty or whitespace-only input
+    """
+    segments = []
+    for sentence in _SENTENCE_BOUNDARY.split(text.strip()):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(", ", 0, max_chars) + 1 or sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            segments.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            segments.append(sentence)
+    return segments or [text]
+
+def length_buckets(lengths:list[int], bucket_size:int=TRANSLATE_BUCKET_SIZE) -> list[list[int]]:
+    """
+    Group segment indices into buckets of similar length to limit padding.
+
+    Args:
+        lengths (list[int]): token count of each segment
+        bucket_size (int, optional): most segments per bucket. Defaults to TRANSLATE_BUCKET_SIZE.
+
+    Returns:
+        buckets (list[list[int]]): segment indices, shortest segments first
+    """
+    buckets = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        bucket = buckets[-1] if buckets else None
+        # Start a new bucket when it is full or when padding would more than double its shortest segment
+        if bucket is None or len(bucket) >= bucket_size or lengths[i] > 2 * max(lengths[bucket[0]], 8):
+            buckets.append([i])
+        else:
+            bucket.append(i)
+    return buckets
+
+class NllbTranslator:
+    """
+    Full-precision PyTorch NLLB translator. Base class of the other backends.
+
+    Args:
+        max_length (int, optional): most tokens generated for one segment. Defaults to 200.
+    """
+
+    name = "torch"
+    model_name = NLLB_MODEL
+    # Whether worker processes forked after `load` can use it, see translator_pool
+    fork_safe = True
+
+    def __init__(self, max_length:int=200):
+        self.max_length = max_length
+        self.tokenizer = None
+        self.model = None
+
+    def load(self):
+        """Load tokenizer and model. Called once by whoever owns the translator."""
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(NLLB_MODEL, src_lang="tur_Latn")
+        self.model = self._load_model()
+        return self
+
+    def _load_model(self):
+        from transformers import AutoModelForSeq2SeqLM
+        return AutoModelForSeq2SeqLM.from_pretrained(NLLB_MODEL)
+
+    def translate_batch(self, articles:list[str]) -> list[str]:
+        """
+        Translate a list of turkish articles to english, sentence by sentence, in length-bucketed `generate` calls.
+
+        Args:
+            articles (list[str]): turkish inputs
+
+        Returns:
+            eng (list[str]): english outputs, in the same order as `articles`
+        """
+        segments, owners = [], []
+        for i, article in enumerate(articles):
+            for segment in split_sentences(article):
+                segments.append(segment)
+                owners.append(i)
+
+        lengths = self._source_lengths(segments)
+        translated = [None] * len(segments)
+        for bucket in length_buckets(lengths):
+            max_length = min(self.max_length, int(max(lengths[i] for i in bucket) * LENGTH_RATIO) + LENGTH_MARGIN)
+            for i, eng in zip(bucket, self._generate([segments[i] for i in bucket], max_length)):
+                translated[i] = eng
+
+        parts = [[] for _ in articles]
+        for owner, eng in zip(owners, translated):
+            parts[owner].append(eng.strip())
+        return [" ".join(part) for part in parts]
+
+    def _source_lengths(self, segments:list[str]) -> list[int]:
+        return [len(ids) for ids in self.tokenizer(segments)["input_ids"]]
+
+    def _generate(self, segments:list[str], max_length:int) -> list[str]:
+        inputs = self.tokenizer(segments, return_tensors="pt", padding=True) # Return PyTorch torch.Tensor objects
+        translated_tokens = self.model.generate(**inputs, forced_bos_token_id=self.tokenizer.lang_code_to_id["eng_Latn"],
+                                                max_length=max_length)
+        return self.tokenizer.batch_decode(translated_tokens, skip_special_tokens=True)
+
+class NllbInt8Translator(NllbTranslator):
+    """NLLB with dynamic int8 quantization of its Linear layers; smaller and faster on CPU."""
+
+    name = "int8"
+
+    def _load_model(self):
+        import torch
+        model = super()._load_model()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class NllbOnnxTranslator(NllbTranslator):
+    """
+    NLLB on ONNX Runtime via optimum. The first load exports the model to `cache_dir`,
+    later loads reuse the exported encoder/decoder graphs. The decoder uses its KV cache.
+
+    Args:
+        max_length (int, optional): most tokens generated for one segment. Defaults to 200.
+        cache_dir (str, optional): directory of the exported model. Defaults to ONNX_CACHE_DIR.
+    """
+
+    name = "onnx"
+    # ONNX Runtime sessions own thread pools that do not survive a fork
+    fork_safe = False
+
+    def __init__(self, max_length:int=200, cache_dir:str=ONNX_CACHE_DIR):
+        super().__init__(max_length=max_length)
+        self.cache_dir = cache_dir
+
+    def _load_model(self):
+        try:
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        except ImportError as e:
+            raise ImportError("The onnx translator backend needs `pip install optimum[onnxruntime]`") from e
+        if os.path.isdir(self.cache_dir):
+            return ORTModelForSeq2SeqLM.from_pretrained(self.cache_dir, use_cache=True)
+        model = ORTModelForSeq2SeqLM.from_pretrained(NLLB_MODEL, export=True, use_cache=True)
+        model.save_pretrained(self.cache_dir)
+        return model
+
+class MBartTranslator(NllbTranslator):
+    """mBART-50 many-to-many translator from turkish (tr_TR) to english (en_XX)."""
+
+    name = "mbart"
+    model_name = MBART_MODEL
+
+    def load(self):
+        from transformers import MBart50TokenizerFast, MBartForConditionalGeneration
+        self.tokenizer = MBart50TokenizerFast.from_pretrained(MBART_MODEL)
+        self.tokenizer.src_lang = "tr_TR"
+        self.model = MBartForConditionalGeneration.from_pretrained(MBART_MODEL)
+        return self
+
+    def _generate(self, segments:list[str], max_length:int) -> list[str]:
+        inputs = self.tokenizer(segments, return_tensors="pt", padding=True)
+        generated_tokens = self.model.generate(**inputs, forced_bos_token_id=self.tokenizer.lang_code_to_id["en_XX"],
+                                               max_length=max_length)
+        return self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+
+class SeamlessTranslator(NllbTranslator):
+    """SeamlessM4T translator, loading only the text-to-text part of the model."""
+
+    name = "seamless"
+    model_name = SEAMLESS_MODEL
+
+    def load(self):
+        from transformers import AutoProcessor, SeamlessM4TForTextToText
+        self.tokenizer = AutoProcessor.from_pretrained(SEAMLESS_MODEL)
+        self.model = SeamlessM4TForTextToText.from_pretrained(SEAMLESS_MODEL)
+        return self
+
+    def _source_lengths(self, segments:list[str]) -> list[int]:
+        return [len(ids) for ids in self.tokenizer(text=segments, src_lang="tur")["input_ids"]]
+
+    def _generate(self, segments:list[str], max_length:int) -> list[str]:
+        inputs = self.tokenizer(text=segments, src_lang="tur", return_tensors="pt", padding=True)
+        output_tokens = self.model.generate(**inputs, tgt_lang="eng", max_new_tokens=max_length)
+        return self.tokenizer.batch_decode(output_tokens, skip_special_tokens=True)
+
+TRANSLATOR_BACKENDS = {
+    NllbTranslator.name: NllbTranslator,
+    NllbInt8Translator.name: NllbInt8Translator,
+    NllbOnnxTranslator.name: NllbOnnxTranslator,
+}
+
+if TRANSLATOR_BACKEND not in TRANSLATOR_BACKENDS:
+    raise ValueError(f"Unknown TRANSLATOR_BACKEND {TRANSLATOR_BACKEND!r}, choose from {sorted(TRANSLATOR_BACKENDS)}")
+
+TRANSLATORS = {
+    "nllb": TRANSLATOR_BACKENDS[TRANSLATOR_BACKEND],
+    "mbart": MBartTranslator,
+    "seamless": SeamlessTranslator,
+}
+
+def create_translator(backend:str=TRANSLATOR_BACKEND) -> NllbTranslator:
+    """
+    Create and load the NLLB translator for a backend name.
+
+    Args:
+        backend (str, optional): one of TRANSLATOR_BACKENDS. Defaults to the TRANSLATOR_BACKEND env var.
+
+    Returns:
+        translator (NllbTranslator): loaded translator
+    """
+    if backend not in TRANSLATOR_BACKENDS:
+        raise ValueError(f"Unknown translator backend {backend!r}, choose from {sorted(TRANSLATOR_BACKENDS)}")
+    return TRANSLATOR_BACKENDS[backend]().load()
+
+def translator_id(name:str) -> str:
+    """Identify the model and backend behind a translator name, e.g. for cache keys."""
+    translator_cls = TRANSLATORS[name]
+    return f"{translator_cls.model_name}:{translator_cls.name}:v{TRANSLATION_VERSION}"
+
+def load_translator(name:str) -> NllbTranslator:
+    """
+    Create and load a translator from the TRANSLATORS registry.
+
+    Args:
+        name (str): one of TRANSLATORS
+
+    Returns:
+        translator (NllbTranslator): loaded translator
+    """
+    if name not in TRANSLATORS:
+        raise ValueError(f"Unknown translator {name!r}, choose from {sorted(TRANSLATORS)}")
+    return TRANSLATORS[name]().load()
+
+CHECK_SENTENCES = [
+    "Bugün hava güneşli ama benim havam bulutlu",
+    "Bu ürünü aldığıma çok pişmanım, kimseye tavsiye etmem.",
+    "Harika bir maçtı, tebrikler!",
+    "Kargo üç gün gecikti ama satıcı çok ilgiliydi.",
+    "Sen ne anlarsın bu işten, sus artık.",
+    "Film fena değildi, sadece biraz uzundu.",
+]
+
+def compare_to_baseline(candidate:NllbTranslator, baseline:NllbTranslator, sentences:list[str]=CHECK_SENTENCES) -> dict:
+    """
+    Compare a translator against the fp32 baseline on the same sentences.
+
+    Args:
+        candidate (NllbTranslator): translator under test
+        baseline (NllbTranslator): full-precision reference
+        sentences (list[str], optional): turkish sentences. Defaults to CHECK_SENTENCES.
+
+    Returns:
+        report (dict): exact match rate, mean token-level similarity and mean latency per sentence of both
+    """
+    report = {"sentences": len(sentences)}
+    outputs = {}
+    for label, translator in (("baseline", baseline), ("candidate", candidate)):
+        start = time.perf_counter()
+        outputs[label] = [translator.translate_batch([sentence])[0] for sentence in sentences]
+        report[f"{label}_seconds_per_sentence"] = (time.perf_counter() - start) / len(sentences)
+
+    similarities = [difflib.SequenceMatcher(None, ref.lower().split(), out.lower().split()).ratio()
+                    for ref, out in zip(outputs["baseline"], outputs["candidate"])]
+    report["exact_match"] = sum(ref == out for ref, out in zip(outputs["baseline"], outputs["candidate"])) / len(sentences)
+    report["mean_similarity"] = sum(similarities) / len(similarities)
+    report["pairs"] = list(zip(sentences, outputs["baseline"], outputs["candidate"]))
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check a translator backend against the fp32 baseline.")
+    parser.add_argument("--backend", default=TRANSLATOR_BACKEND, choices=sorted(TRANSLATOR_BACKENDS))
+    parser.add_argument("--min-similarity", type=float, default=0.8, help="fail below this mean similarity. Defaults to 0.8")
+    args = parser.parse_args()
+
+    report = compare_to_baseline(create_translator(args.backend), create_translator("torch"))
+    for sentence, ref, out in report.pop("pairs"):
+        print(f"{sentence}\n  fp32: {ref}\n  {args.backend}: {out}")
+    print(report)
+    if report["mean_similarity"] < args.min_similarity:
+        raise SystemExit(f"{args.backend} drifted from the fp32 baseline: {report['mean_similarity']:.2f} < {args.min_similarity}")
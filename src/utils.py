@@ -1,19 +1,128 @@
 import json
 import os
+import threading
+from typing import Iterator, Optional
 
 import requests
+from batching import MicroBatcher
+from metrics import Gauge
 from dotenv import load_dotenv
-from openai import OpenAI
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from model_cache import ModelCache
+from score_stream import ScoreExtractor
+from structured_output import structured_request_fields
+from translator_pool import TRANSLATOR_WORKERS, get_translator_pool
+from translators import TRANSLATORS, load_translator
 
 load_dotenv()
 LOCAL_MODEL = os.environ.get("LOCAL_MODEL")
 URL = os.environ.get("URL")
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL")
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+TRANSLATE_MAX_BATCH_SIZE = int(os.environ.get("TRANSLATE_MAX_BATCH_SIZE", 8))
+TRANSLATE_MAX_WAIT_MS = float(os.environ.get("TRANSLATE_MAX_WAIT_MS", 10))
+DB_PATH = os.environ.get("DB_PATH", "../logs.db")
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 120))
+# How long Ollama keeps the model, and the evaluated prompt prefix, loaded after a request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OPENAI_ONLY = os.environ.get("OPENAI_ONLY", "0") == "1"
+TRANSLATOR = os.environ.get("TRANSLATOR", "nllb")
+MODEL_CACHE_MAX_MODELS = int(os.environ.get("MODEL_CACHE_MAX_MODELS", 2))
+MODEL_CACHE_MAX_GB = float(os.environ.get("MODEL_CACHE_MAX_GB", 8))
+# "translate": NLLB then the local LLM, "direct": turkish straight to the local LLM,
+# "shadow": serve "translate" and compare it with "direct" on a sample of requests
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "translate")
+SHADOW_SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", 0.05))
+PIPELINE_MODES = ("translate", "direct", "shadow")
+if PIPELINE_MODE not in PIPELINE_MODES:
+    raise ValueError(f"Unknown PIPELINE_MODE '{PIPELINE_MODE}'. Choose one of: {', '.join(PIPELINE_MODES)}")
+# Shared session so calls to the Ollama server reuse keep-alive connections
+session = requests.Session()
 
-tokenizer = AutoTokenizer.from_pretrained("facebook/nllb-200-distilled-600M", src_lang="tur_Latn")
-model = AutoModelForSeq2SeqLM.from_pretrained("facebook/nllb-200-distilled-600M")
+# Models and clients are built on first use, so importing this module stays cheap
+_openai_client = None
+_load_lock = threading.Lock()
+
+def _load_translator(name:str):
+    if OPENAI_ONLY:
+        raise RuntimeError("Translation is disabled because OPENAI_ONLY=1")
+    return load_translator(name)
+
+# Translators are loaded once into a shared cache; idle ones are evicted when it is full
+translator_cache = ModelCache(_load_translator,
+                              max_models=MODEL_CACHE_MAX_MODELS,
+                              max_bytes=int(MODEL_CACHE_MAX_GB * 1024 ** 3))
+_batchers = {}
+Gauge("translation_queue_depth", "Comments waiting for a translation batch.", ("translator",),
+      fn=lambda: {(name,): batcher._queue.qsize() for name, batcher in list(_batchers.items())})
+
+def get_openai_client():
+    """Create the OpenAI client once, on first use. Safe to call from several threads."""
+    global _openai_client
+    if _openai_client is None:
+        with _load_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _openai_client
+
+def warm_up(translate:bool=not OPENAI_ONLY and PIPELINE_MODE != "direct", translator:str=TRANSLATOR):
+    """
+    Load the translator ahead of the first request, e.g. before launching the Gradio app.
+
+    Args:
+        translate (bool, optional): load the translator and run one translation. Defaults to True unless OPENAI_ONLY=1
+            or PIPELINE_MODE=direct.
+        translator (str, optional): translator name. Defaults to the TRANSLATOR env var.
+    """
+    if translate:
+        translate_batch(["Merhaba"], translator=translator)
+
+def translate_batch(articles:list[str], translator:str=TRANSLATOR) -> list[str]:
+    """
+    Translate a list of turkish articles to english, sentence by sentence in length-bucketed `generate` calls.
+    With TRANSLATOR_WORKERS set, the batch runs in a worker process of the translator pool.
+
+    Args:
+        articles (list[str]): turkish inputs
+        translator (str, optional): one of translators.TRANSLATORS. Defaults to the TRANSLATOR env var.
+
+    Returns:
+        eng (list[str]): english outputs, in the same order as `articles`
+    """
+    if TRANSLATOR_WORKERS > 0:
+        if OPENAI_ONLY:
+            raise RuntimeError("Translation is disabled because OPENAI_ONLY=1")
+        return get_translator_pool(translator).translate_batch(articles)
+    with translator_cache.use(translator) as model:
+        eng = model.translate_batch(articles)
+    return eng
+
+def translate_tr_to_eng(article:str, translator:str=TRANSLATOR) -> str:
+    """
+    Translate a single turkish article to english. Concurrent calls for the same translator are
+    grouped by a MicroBatcher and translated together.
+
+    Args:
+        article (str): turkish input
+        translator (str, optional): one of translators.TRANSLATORS. Defaults to the TRANSLATOR env var.
+
+    Returns:
+        eng (str): english output.
+    """
+    if translator not in TRANSLATORS:
+        raise ValueError(f"Unknown translator {translator!r}, choose from {sorted(TRANSLATORS)}")
+    batcher = _batchers.get(translator)
+    if batcher is None:
+        with _load_lock:
+            batcher = _batchers.get(translator)
+            if batcher is None:
+                batcher = MicroBatcher(lambda articles: translate_batch(articles, translator=translator),
+                                       max_batch_size=TRANSLATE_MAX_BATCH_SIZE,
+                                       max_wait_ms=TRANSLATE_MAX_WAIT_MS,
+                                       name=f"{translator}-batcher",
+                                       concurrency=max(1, TRANSLATOR_WORKERS))
+                _batchers[translator] = batcher
+    eng = batcher.submit(article)
+    return eng
 
 def nllb_translate_tr_to_eng(article:str = "Bugün hava güneşli ama benim havam bulutlu") -> str:
     """Translate from turkish to english using facebook:nllb-200-distilled-600M on hface. 
@@ -28,10 +137,11 @@ def nllb_translate_tr_to_eng(article:str = "Bugün hava güneşli ama benim hava
     Returns:
         eng (str): english output.
     """
-    inputs = tokenizer(article, return_tensors="pt") # Return PyTorch torch.Tensor objects
-    translated_tokens = model.generate(**inputs, forced_bos_token_id=tokenizer.lang_code_to_id["eng_Latn"], max_length=30)
-    eng = tokenizer.batch_decode(translated_tokens, skip_special_tokens=True)[0]
-    return eng
+    return translate_tr_to_eng(article, translator="nllb")
+
+def nllb_translate_batch(articles:list[str]) -> list[str]:
+    """Translate a list of turkish articles to english with NLLB, see `translate_batch`."""
+    return translate_batch(articles, translator="nllb")
 
 def mbart_translate_tr_to_eng(article:str = "Bugün hava güneşli ama benim havam bulutlu") -> str:
     """Translate from turkish to english using facebook:mbart-large-50-many-to-many-mmt on hface. 
@@ -40,56 +150,89 @@ def mbart_translate_tr_to_eng(article:str = "Bugün hava güneşli ama benim hav
     - after removing imports outside, it takes 12.5s
     - after removing imports, tokenizer, model outside, it takes 1.9s
 
+    The model is now kept in `translator_cache`, so only the first call pays the load time.
+
     Args:
         article (str, optional): turkish input. Defaults to "Bugün hava güneşli ama benim havam bulutlu".
 
     Returns:
         eng (str): english output.
     """
-    from transformers import MBart50TokenizerFast, MBartForConditionalGeneration
-    model = MBartForConditionalGeneration.from_pretrained("facebook/mbart-large-50-many-to-many-mmt")
-    tokenizer = MBart50TokenizerFast.from_pretrained("facebook/mbart-large-50-many-to-many-mmt")   
-    tokenizer.src_lang = "tr_TR"
-
-    inputs = tokenizer(article, return_tensors="pt")
-    generated_tokens = model.generate(**inputs, forced_bos_token_id=tokenizer.lang_code_to_id["en_XX"])
-    eng = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)[0]
-    return eng
+    return translate_tr_to_eng(article, translator="mbart")
 
-def get_local_completion(prompt:str, model:str=LOCAL_MODEL, url:str=f"{URL}/api/generate") -> str:
+def stream_local_completion(prompt:str, model:str=LOCAL_MODEL, url:str=f"{URL}/api/generate",
+                            stop_when_scored:bool=False, structured:bool=False,
+                            system:Optional[str]=None) -> Iterator[ScoreExtractor]:
     """
-    Send a single prompt to local ollama API and return the response.
-    See https://github.com/jmorganca/ollama.
+    Stream a prompt's response from the local ollama API, parsing scores as the tokens arrive.
 
     Args:
         prompt (str): prompt to send to the local API
-        model (str, optional): Ollama model type. Defaults to "phi".
+        model (str, optional): Ollama model type. Defaults to LOCAL_MODEL.
         url (str, optional): Ollama REST API URL
+        stop_when_scored (bool, optional): close the stream, which makes Ollama cancel the
+            generation, as soon as both scores are parsed. Defaults to False.
+        structured (bool, optional): constrain the output to the score JSON schema and cap its length,
+            see structured_output.py. Defaults to False.
+        system (str, optional): system prompt placed before `prompt`. Keep it identical across calls so
+            Ollama reuses its evaluated context. Defaults to the model's own system prompt.
 
-    Returns:
-        response_content (str): response from local ollama API
+    Yields:
+        extractor (ScoreExtractor): the same extractor after every chunk, holding the text and scores so far
     """
     data = {
-        "prompt": prompt, "model": model, "stream": True
+        "prompt": prompt, "model": model, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE
     }
-    response = requests.post(url, json=data)
-    response.raise_for_status()
-    parts = []
-    for line in response.iter_lines():
-        body = json.loads(line)
-        if "error" in body:
-            raise Exception(body["error"])
+    if system is not None:
+        data["system"] = system
+    if structured:
+        data.update(structured_request_fields())
+    response = session.post(url, json=data, timeout=OLLAMA_TIMEOUT, stream=True)
+    try:
+        response.raise_for_status()
+        extractor = ScoreExtractor()
+        for line in response.iter_lines():
+            body = json.loads(line)
+            if "error" in body:
+                raise Exception(body["error"])
 
-        content = body.get("response", "")
-        parts.append(content)
+            extractor.feed(body.get("response", ""))
+            if body.get("done"):
+                extractor.finish()
+            yield extractor
 
-        if body.get("done"):
-            break
+            if body.get("done") or (stop_when_scored and extractor.complete):
+                break
+    finally:
+        # Dropping the connection mid-stream is what stops the generation on the server
+        response.close()
 
-    response_content = "".join(parts).strip()
+def get_local_completion(prompt:str, model:str=LOCAL_MODEL, url:str=f"{URL}/api/generate",
+                         stop_when_scored:bool=False, structured:bool=False, system:Optional[str]=None) -> str:
+    """
+    Send a single prompt to local ollama API and return the response.
+    See https://github.com/jmorganca/ollama.
+
+    Args:
+        prompt (str): prompt to send to the local API
+        model (str, optional): Ollama model type. Defaults to "phi".
+        url (str, optional): Ollama REST API URL
+        stop_when_scored (bool, optional): stop generating once 'sentiment_score' and 'offensive_score'
+            are parsed and return just those as a JSON object. Only for single-comment prompts. Defaults to False.
+        structured (bool, optional): constrain the output to the score JSON schema. Only for single-comment prompts. Defaults to False.
+        system (str, optional): system prompt placed before `prompt`. Defaults to the model's own system prompt.
+
+    Returns:
+        response_content (str): response from local ollama API
+    """
+    extractor = ScoreExtractor()
+    for extractor in stream_local_completion(prompt, model=model, url=url, stop_when_scored=stop_when_scored,
+                                             structured=structured, system=system):
+        pass
+    response_content = extractor.to_response() if stop_when_scored else extractor.text.strip()
     return response_content
 
-def get_openai_completion(prompt:str, model:str=OPENAI_MODEL, temperature:int=0) -> str:
+def get_openai_completion(prompt:str, model:str=OPENAI_MODEL, temperature:int=0, system:Optional[str]=None) -> str:
     """
     Send a single prompt to the OpenAI API and return the response.
 
@@ -97,17 +240,20 @@ def get_openai_completion(prompt:str, model:str=OPENAI_MODEL, temperature:int=0)
         prompt (str): prompt to send to the API
         model (str, optional): OpenAI model type. Defaults to "gpt-3.5-turbo".
         temperature (int, optional): degree of randomness of the model's output. It changes the variety of model's response. Defaults to 0.
+        system (str, optional): system message sent before the prompt. Defaults to None.
 
     Returns:
         response.choices[0].message.content (str): response from the OpenAI API
     """
+    messages = [{"role": "user", "content": prompt}]
+    if system is not None:
+        # First, so every request starts with the same tokens and the provider's prompt cache applies
+        messages.insert(0, {"role": "system", "content": system})
 
-    response = client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
       model=model,
       response_format={ "type": "json_object" },
-      messages=[
-        {"role": "user", "content": prompt},
-      ],
+      messages=messages,
       temperature=temperature,
     )
     return response.choices[0].message.content